@@ -20,19 +20,50 @@
 
 """Reference implementation for Bech32 and segwit addresses."""
 
+from lazyimport import lazy_import
+
+# Optional, for bech32_verify_many.  Loading it is slow, so only done on use.
+numpy = lazy_import('numpy')
 
 CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
 
+# XOR of the generator words selected by each possible 5-bit top value, so
+# the checksum can be stepped with one lookup per symbol.
+POLYMOD_TABLE = [0] * 32
+for top in range(32):
+    for i in range(5):
+        if (top >> i) & 1:
+            POLYMOD_TABLE[top] ^= GENERATOR[i]
+del top, i
 
-def bech32_polymod(values):
-    """Internal function that computes the Bech32 checksum."""
-    generator = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+# bytes.translate() tables: map charset characters to their 5-bit value
+# (anything else to 0xff), and strip printable US-ASCII characters.
+CHARSET_REV = bytes(CHARSET.find(chr(c)) & 0xff for c in range(256))
+PRINTABLE = bytes(range(33, 127))
+
+# bytes.translate() tables for bech32_hrp_expand.
+HRP_HIGH = bytes(c >> 5 for c in range(256))
+HRP_LOW = bytes(c & 31 for c in range(256))
+
+
+def bech32_polymod_ref(values):
+    """Reference (bit-by-bit) Bech32 checksum, kept for testing."""
     chk = 1
     for value in values:
         top = chk >> 25
         chk = (chk & 0x1ffffff) << 5 ^ value
         for i in range(5):
-            chk ^= generator[i] if ((top >> i) & 1) else 0
+            chk ^= GENERATOR[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def bech32_polymod(values):
+    """Internal function that computes the Bech32 checksum."""
+    table = POLYMOD_TABLE
+    chk = 1
+    for value in values:
+        chk = ((chk & 0x1ffffff) << 5 ^ value) ^ table[chk >> 25]
     return chk
 
 
@@ -59,8 +90,8 @@ def bech32_encode(hrp, data):
     return hrp + '1' + ''.join([CHARSET[d] for d in combined])
 
 
-def bech32_decode(bech):
-    """Validate a Bech32 string, and determine HRP and data."""
+def bech32_decode_ref(bech):
+    """Reference Bech32 decoder, kept for testing."""
     if ((any(ord(x) < 33 or ord(x) > 126 for x in bech)) or
             (bech.lower() != bech and bech.upper() != bech)):
         return (None, None)
@@ -72,11 +103,92 @@ def bech32_decode(bech):
         return (None, None)
     hrp = bech[:pos]
     data = [CHARSET.find(x) for x in bech[pos+1:]]
+    if bech32_polymod_ref(bech32_hrp_expand(hrp) + data) != 1:
+        return (None, None)
+    return (hrp, data[:-6])
+
+
+def bech32_split(bech):
+    """Check all but the checksum: returns HRP, and data as bytes."""
+    try:
+        raw = bech.encode('ascii')
+    except UnicodeEncodeError:
+        return (None, None)
+    if raw.translate(None, PRINTABLE):
+        return (None, None)
+    lower = raw.lower()
+    if lower != raw and raw.upper() != raw:
+        return (None, None)
+    pos = lower.rfind(b'1')
+    if pos < 1 or pos + 7 > len(lower): #or len(bech) > 90:
+        return (None, None)
+    data = lower[pos+1:].translate(CHARSET_REV)
+    if b'\xff' in data:
+        return (None, None)
+    return (lower[:pos].decode('ascii'), data)
+
+
+def bech32_decode(bech):
+    """Validate a Bech32 string, and determine HRP and data."""
+    hrp, data = bech32_split(bech)
+    if hrp is None:
+        return (None, None)
+    data = list(data)
     if not bech32_verify_checksum(hrp, data):
         return (None, None)
     return (hrp, data[:-6])
 
 
+def bech32_verify_many(bechs, min_batch=64):
+    """Validate many Bech32 strings: returns a mask and HRP/data splits.
+
+    The mask is a list of bools saying which strings are valid, and the
+    splits are what bech32_decode would return for each.  With NumPy,
+    checksums of similar-length strings are computed together, in
+    batches; without it, this just calls bech32_decode.
+    """
+    if numpy is None:
+        splits = [bech32_decode(bech) for bech in bechs]
+        return [hrp is not None for hrp, data in splits], splits
+
+    splits = [bech32_split(bech) for bech in bechs]
+    mask = numpy.zeros(len(splits), dtype=bool)
+    buckets = {}
+    for i, (hrp, data) in enumerate(splits):
+        if hrp is not None:
+            raw = hrp.encode('ascii')
+            values = raw.translate(HRP_HIGH) + b'\0' + raw.translate(HRP_LOW) + data
+            indices, rows = buckets.setdefault(len(values) // 128, ([], []))
+            indices.append(i)
+            rows.append(values)
+
+    table = numpy.array(POLYMOD_TABLE, dtype=numpy.uint32)
+    for width, (indices, rows) in buckets.items():
+        # Batching only pays off for enough strings.
+        if len(rows) < min_batch:
+            mask[indices] = [bech32_polymod(values) == 1 for values in rows]
+            continue
+
+        # Rows are left-padded with zeroes then a 1, and start from 0: the
+        # checksum stays 0 over the zeroes, and the 1 sets it to the usual
+        # starting value of 1.
+        width = (width + 1) * 128
+        padded = b''.join(bytes(width - len(values) - 1) + b'\x01' + values
+                          for values in rows)
+        # One row per position, one column per string.
+        values = numpy.frombuffer(padded, dtype=numpy.uint8).reshape(len(rows), width)
+        values = numpy.ascontiguousarray(values.T)
+        chk = numpy.zeros(len(rows), dtype=numpy.uint32)
+        for value in values:
+            chk = ((chk & 0x1ffffff) << 5 ^ value) ^ table[chk >> 25]
+        mask[indices] = chk == 1
+
+    mask = mask.tolist()
+    splits = [(hrp, list(data[:-6])) if ok else (None, None)
+              for ok, (hrp, data) in zip(mask, splits)]
+    return mask, splits
+
+
 def convertbits(data, frombits, tobits, pad=True):
     """General power-of-2 base conversion."""
     acc = 0
@@ -0,0 +1,439 @@
+#! /usr/bin/env python3
+from bech32 import bech32_decode
+from binascii import unhexlify
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from lnaddr import (lndecode, lndecode_many, LnAddr, InvoiceSigner, addr_to_dict,
+                    check_signature, parse_field, parse_hrp,
+                    signing_data, tag_offsets, u5_to_int)
+from lnindex import InvoiceIndex
+
+import argparse
+import collections
+import json
+import lnecdsa
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+# Same test keypair as examples.sh.
+PRIVKEY = 'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+PUBKEY = unhexlify('03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad')
+
+# Fallback addresses of each type, per currency.
+FALLBACKS = {
+    'bc': ['1RustyRX2oai4EYYDpQGWvEL62BBGqN9T',
+           '3EktnHQD7RiAE6uzMj2ZifT9YgRrkSgzQX',
+           'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4',
+           'bc1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3qccfmv3'],
+    'tb': ['mk2QpYatsKicvFVuTAQLBryyccRXMUaGHP',
+           '2MzQwSSnBHWHqSAqtTVQ6v47XtaisrJa1Vc',
+           'tb1qw508d6qejxtdg4y5r3zarvary0c5xw7kxpjzsx',
+           'tb1qrp33g0q5c5txsp9arysrx4k6zdkfs4nce4xj0gdcccefvpysxf3q0sl5k7'],
+}
+
+
+def make_addrs(count, seed):
+    """ LnAddrs using every tag lnencode supports: deterministic for a seed.
+    """
+    r = random.Random(seed)
+    addrs = []
+    for i in range(count):
+        currency = r.choice(['bc', 'bc', 'bc', 'tb'])
+        tags = []
+        if r.random() < 0.5:
+            tags.append(('d', ' '.join(r.choice(['one', 'cup', 'of', 'coffee', 'and', 'a', 'pie'])
+                                       for _ in range(r.randrange(1, 40)))))
+        else:
+            tags.append(('h', 'long description {}'.format(i)))
+        if r.random() < 0.5:
+            tags.append(('x', r.choice([60, 600, 3600, 86400, 604800])))
+        if r.random() < 0.4:
+            tags.append(('f', r.choice(FALLBACKS[currency])))
+        if r.random() < 0.2:
+            tags.append(('n', PUBKEY))
+        for _ in range(r.choice([0, 0, 1, 1, 2])):
+            tags.append(('r', [(bytes([2 + r.getrandbits(1)]) + bytes(r.getrandbits(8) for _ in range(32)),
+                                bytes(r.getrandbits(8) for _ in range(8)),
+                                r.randrange(10000), r.randrange(10000), r.randrange(9, 1000))
+                               for _ in range(r.randrange(1, 5))]))
+        r.shuffle(tags)
+        amount_msat = None
+        if r.random() < 0.9:
+            amount_msat = r.randrange(1, 10**9)
+        addrs.append(LnAddr(bytes(r.getrandbits(8) for _ in range(32)),
+                            amount_msat=amount_msat, currency=currency, tags=tags,
+                            date=1496314658 + i))
+    return addrs
+
+
+def make_corpus(count, seed):
+    """ Signed invoices to decode: deterministic for a given seed.
+    """
+    signer = InvoiceSigner(PRIVKEY)
+    return signer.encode_many(make_addrs(count, seed))
+
+
+def scaling(options):
+    """ Decode throughput of lndecode_many as workers are added.
+    """
+    corpus = make_corpus(options.count, options.seed)
+    pool = ProcessPoolExecutor if options.executor == 'process' else ThreadPoolExecutor
+
+    base = None
+    for workers in range(1, options.max_workers + 1):
+        with pool(workers) as executor:
+            start = time.perf_counter()
+            for r in lndecode_many(corpus, executor, chunksize=options.chunksize):
+                if isinstance(r, Exception):
+                    raise r
+            elapsed = time.perf_counter() - start
+        rate = len(corpus) / elapsed
+        if base is None:
+            base = rate
+        print("{} {} workers: {:.0f} invoices/sec ({:.2f}x)".format(
+            options.executor, workers, rate, rate / base))
+
+
+def per_invoice(func, corpus, repeat):
+    """ Best-of-repeat time to apply func to each invoice, in microseconds.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for a in corpus:
+            func(a)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(corpus) * 1e6
+
+
+class PerKeyContext(object):
+    # secp256k1 keys given ctx=None create (and destroy) their own context,
+    # as lndecode used to.
+    ctx = None
+
+
+def context(options):
+    """ Per-invoice cost with a fresh secp256k1 context per key vs. shared.
+    """
+    corpus = make_corpus(options.count, options.seed)
+
+    backend = lnecdsa.set_backend('secp256k1')
+    shared = backend.context
+    try:
+        backend.context = PerKeyContext()
+        before = per_invoice(lndecode, corpus, options.repeat)
+    finally:
+        backend.context = shared
+    after = per_invoice(lndecode, corpus, options.repeat)
+
+    print("lndecode, context per key: {:.1f} us/invoice".format(before))
+    print("lndecode, shared context: {:.1f} us/invoice".format(after))
+    print("saving: {:.1f} us/invoice ({:.0f}%)".format(
+        before - after, (before - after) / before * 100))
+
+
+def memory(options):
+    """ Memory held per decoded invoice.
+    """
+    corpus = make_corpus(options.count, options.seed)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    decoded = [lndecode(a) for a in corpus]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("{} invoices: {:.0f} bytes/invoice".format(
+        len(decoded), (after - before) / len(decoded)))
+
+
+def stage_timings(count, seed, repeat):
+    """ Microseconds per invoice for each stage of lndecode, and lnencode.
+    """
+    addrs = make_addrs(count, seed)
+    corpus = InvoiceSigner(PRIVKEY).encode_many(addrs)
+
+    bech32 = [bech32_decode(a) for a in corpus]
+    def unpack(hd):
+        hrp, data = hd
+        sigdecoded = u5_to_int(data[-104:]).to_bytes(65, 'big')
+        return hrp, data[:-104], sigdecoded, tag_offsets(data[:-104])
+    unpacked = [unpack(hd) for hd in bech32]
+
+    def parse(u):
+        hrp, data, sigdecoded, offsets = u
+        addr = LnAddr()
+        addr.pubkey = None
+        parse_hrp(addr, hrp)
+        addr.date = u5_to_int(data[0:7])
+        for tag, start, end in offsets:
+            parse_field(addr, tag, data[start:end])
+        return addr
+    parsed = [(u, parse(u).pubkey) for u in unpacked]
+
+    def signature(p):
+        (hrp, data, sigdecoded, offsets), pubkey = p
+        addr = LnAddr()
+        addr.pubkey = pubkey
+        check_signature(addr, signing_data(hrp, data), sigdecoded)
+
+    signer = InvoiceSigner(PRIVKEY)
+    stages = collections.OrderedDict()
+    stages['bech32_decode'] = per_invoice(bech32_decode, corpus, repeat)
+    stages['unpack'] = per_invoice(unpack, bech32, repeat)
+    stages['parse_tags'] = per_invoice(parse, unpacked, repeat)
+    stages['signature'] = per_invoice(signature, parsed, repeat)
+    stages['lndecode'] = per_invoice(lndecode, corpus, repeat)
+    stages['lnencode'] = per_invoice(signer.encode, addrs, repeat)
+    return stages
+
+
+def timed(func, items):
+    """ Time to apply func to each item once, in microseconds per item.
+    """
+    start = time.perf_counter()
+    for a in items:
+        func(a)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def index(options):
+    """ InvoiceIndex insert, lookup and removal costs at scale.
+    """
+    r = random.Random(options.seed)
+    # The index only uses payees' serialized keys.
+    payees = [bytes([2 + r.getrandbits(1)]) + r.getrandbits(256).to_bytes(32, 'big')
+              for _ in range(options.payees)]
+    # Unsigned LnAddrs, ten per second: signing millions would take hours.
+    tags = [('d', 'coffee')]
+    def make(count, date):
+        addrs = []
+        for i in range(count):
+            addr = LnAddr(r.getrandbits(256).to_bytes(32, 'big'), tags=tags, date=date + i // 10)
+            addr.pubkey = r.choice(payees)
+            addrs.append(addr)
+        return addrs
+
+    start = 1496314658
+    addrs = make(options.count, start)
+    end = start + options.count // 10
+    idx = InvoiceIndex()
+    t = time.perf_counter()
+    idx.add_many(addrs)
+    print("add_many, {} invoices: {:.2f} us/invoice".format(
+        options.count, (time.perf_counter() - t) / options.count * 1e6))
+
+    ops = options.ops
+    print("add, in date order: {:.2f} us".format(timed(idx.add, make(ops, end))))
+    late = make(ops, start)
+    for addr in late:
+        addr.date = r.randrange(start, end)
+    print("add, out of date order: {:.2f} us".format(timed(idx.add, late)))
+
+    hashes = [a.paymenthash for a in r.sample(addrs, ops)]
+    print("get, hit: {:.2f} us".format(timed(idx.get, hashes)))
+    print("get, miss: {:.2f} us".format(
+        timed(idx.get, [r.getrandbits(256).to_bytes(32, 'big') for _ in range(ops)])))
+    print("for_payee ({} invoices each): {:.2f} us".format(
+        len(idx) // options.payees, timed(idx.for_payee, r.sample(payees, min(ops, len(payees))))))
+    print("between, 60 second window: {:.2f} us".format(
+        timed(lambda date: idx.between(date, date + 60),
+              [r.randrange(start, end) for _ in range(ops)])))
+    print("remove: {:.2f} us".format(timed(idx.remove, hashes)))
+
+
+def startup(options):
+    """ Cost of a CLI invocation, against a request to serve-stdio.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(here, 'lightning-address.py')
+    invoice = make_corpus(1, options.seed)[0]
+
+    def run(args):
+        best = None
+        for _ in range(options.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable] + args, cwd=here, check=True,
+                           stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000
+
+    print("python -c pass: {:.1f} ms".format(run(['-c', 'pass'])))
+    print("import lnaddr: {:.1f} ms".format(run(['-c', 'import lnaddr'])))
+    print("lightning-address.py --help: {:.1f} ms".format(run([script, '--help'])))
+    print("lightning-address.py decode: {:.1f} ms".format(run([script, 'decode', invoice])))
+
+    proc = subprocess.Popen([sys.executable, script, 'serve-stdio'], cwd=here,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    request = json.dumps({'method': 'decode', 'invoice': invoice}) + '\n'
+    # The first request pays for the lazy imports.
+    proc.stdin.write(request)
+    proc.stdin.flush()
+    proc.stdout.readline()
+    start = time.perf_counter()
+    for _ in range(options.requests):
+        proc.stdin.write(request)
+        proc.stdin.flush()
+        json.loads(proc.stdout.readline())['result']
+    elapsed = time.perf_counter() - start
+    proc.stdin.close()
+    proc.wait()
+    print("serve-stdio decode: {:.2f} ms/request".format(elapsed / options.requests * 1000))
+
+
+def git_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def backends(options):
+    """ Signing, recovery and verification cost with each ECDSA backend.
+
+    Every backend signs the same invoices, and must give the same results.
+    """
+    addrs = make_addrs(options.count, options.seed)
+    # Invoices with `n` are verified against it; the rest need recovery.
+    has_n = [any(k == 'n' for k, v in addr.tags) for addr in addrs]
+
+    expected = None
+    for name, backend in lnecdsa.available_backends().items():
+        lnecdsa.backend = backend
+        signer = InvoiceSigner(PRIVKEY)
+        repeat = 1 if backend.slow else options.repeat
+        corpus = signer.encode_many(addrs)
+        decoded = [addr_to_dict(lndecode(a)) for a in corpus]
+        if expected is None:
+            expected = (corpus, decoded)
+        elif (corpus, decoded) != expected:
+            raise ValueError("{} gives different results".format(name))
+
+        sign = per_invoice(signer.encode, addrs, repeat)
+        recover = per_invoice(lndecode, [a for a, n in zip(corpus, has_n) if not n], repeat)
+        verify = per_invoice(lndecode, [a for a, n in zip(corpus, has_n) if n], repeat)
+        print("{:<10} lnencode {:8.1f}  lndecode (recover) {:8.1f}  lndecode (n) {:8.1f} us/invoice".format(
+            name, sign, recover, verify))
+    lnecdsa.backend = None
+    print("chosen automatically:", lnecdsa.get_backend().name)
+
+
+def stages(options):
+    """ Per-stage timings, optionally appended to a JSON-lines results file.
+    """
+    result = collections.OrderedDict([
+        ('time', int(time.time())),
+        ('version', git_version()),
+        ('python', platform.python_version()),
+        ('count', options.count),
+        ('seed', options.seed),
+        ('stages', stage_timings(options.count, options.seed, options.repeat)),
+    ])
+
+    previous = None
+    if options.compare:
+        with open(options.compare) as f:
+            lines = [l for l in f if l.strip()]
+        if lines:
+            previous = json.loads(lines[-1])
+
+    for name, us in result['stages'].items():
+        line = "{:<14} {:9.1f} us/invoice".format(name, us)
+        if previous and name in previous['stages']:
+            old = previous['stages'][name]
+            line += "  ({:+.1f}% vs {})".format((us - old) / old * 100, previous['version'])
+        print(line)
+
+    if options.json:
+        with open(options.json, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+parser = argparse.ArgumentParser(description='Benchmark invoice encoding and decoding')
+subparsers = parser.add_subparsers(dest='subparser_name',
+                                   help='sub-command help')
+
+parser_scaling = subparsers.add_parser('scaling', help='lndecode_many throughput across cores')
+parser_scaling.add_argument('--count', type=int, default=5000,
+                            help='Number of invoices to decode')
+parser_scaling.add_argument('--seed', type=int, default=1,
+                            help='Seed for the generated invoices')
+parser_scaling.add_argument('--executor', choices=['process', 'thread'], default='process',
+                            help='Pool type to decode with')
+parser_scaling.add_argument('--max-workers', type=int, default=os.cpu_count(),
+                            help='Largest pool size to try')
+parser_scaling.add_argument('--chunksize', type=int, default=64,
+                            help='Invoices per task')
+parser_scaling.set_defaults(func=scaling)
+
+parser_context = subparsers.add_parser('context', help='Shared vs per-key secp256k1 context')
+parser_context.add_argument('--count', type=int, default=1000,
+                            help='Number of invoices to decode')
+parser_context.add_argument('--seed', type=int, default=1,
+                            help='Seed for the generated invoices')
+parser_context.add_argument('--repeat', type=int, default=5,
+                            help='Runs to take the best of')
+parser_context.set_defaults(func=context)
+
+parser_backends = subparsers.add_parser('backends', help='Compare ECDSA backends')
+parser_backends.add_argument('--count', type=int, default=100,
+                             help='Number of invoices in the corpus')
+parser_backends.add_argument('--seed', type=int, default=1,
+                             help='Seed for the generated invoices')
+parser_backends.add_argument('--repeat', type=int, default=5,
+                             help='Runs to take the best of (once for slow backends)')
+parser_backends.set_defaults(func=backends)
+
+parser_memory = subparsers.add_parser('memory', help='Memory per decoded invoice')
+parser_memory.add_argument('--count', type=int, default=2000,
+                           help='Number of invoices to decode')
+parser_memory.add_argument('--seed', type=int, default=1,
+                           help='Seed for the generated invoices')
+parser_memory.set_defaults(func=memory)
+
+parser_stages = subparsers.add_parser('stages', help='Per-stage decode and encode timings')
+parser_stages.add_argument('--count', type=int, default=1000,
+                           help='Number of invoices in the corpus')
+parser_stages.add_argument('--seed', type=int, default=1,
+                           help='Seed for the generated invoices')
+parser_stages.add_argument('--repeat', type=int, default=5,
+                           help='Runs to take the best of')
+parser_stages.add_argument('--json', metavar='FILE',
+                           help='Append results to FILE as a JSON line')
+parser_stages.add_argument('--compare', metavar='FILE',
+                           help='Compare with the last results in FILE')
+parser_stages.set_defaults(func=stages)
+
+parser_index = subparsers.add_parser('index', help='InvoiceIndex costs at scale')
+parser_index.add_argument('--count', type=int, default=10000000,
+                          help='Number of invoices to index')
+parser_index.add_argument('--ops', type=int, default=10000,
+                          help='Number of each operation to time')
+parser_index.add_argument('--payees', type=int, default=1000,
+                          help='Number of distinct payee pubkeys')
+parser_index.add_argument('--seed', type=int, default=1,
+                          help='Seed for the generated invoices')
+parser_index.set_defaults(func=index)
+
+parser_startup = subparsers.add_parser('startup', help='CLI startup vs. serve-stdio')
+parser_startup.add_argument('--repeat', type=int, default=10,
+                            help='Runs to take the best of')
+parser_startup.add_argument('--requests', type=int, default=1000,
+                            help='Requests to time against serve-stdio')
+parser_startup.add_argument('--seed', type=int, default=1,
+                            help='Seed for the generated invoice')
+parser_startup.set_defaults(func=startup)
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    if not options.subparser_name:
+        parser.print_help()
+    else:
+        options.func(options)
@@ -0,0 +1,46 @@
+import importlib
+import importlib.util
+import threading
+
+
+class LazyModule(object):
+    """ Stands in for a module, importing it on first attribute access.
+
+    The import itself is an ordinary one (so the module only appears in
+    sys.modules once fully loaded), done under a lock so that several
+    threads can safely make the first access at once.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            with self._lock:
+                module = self._module
+                if module is None:
+                    module = importlib.import_module(self._name)
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return "<lazy module '{}'>".format(self._name)
+
+
+def lazy_import(name):
+    """ Module `name`, only actually imported on first attribute access.
+
+    Returns None if the module isn't installed, so optional dependencies
+    can still be tested for with `if module is None`.
+    """
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
@@ -1,19 +1,42 @@
 #! /usr/bin/env python3
 from binascii import hexlify, unhexlify
-from lnaddr import lnencode, lndecode, LnAddr
+from lnaddr import (lnencode, lndecode, lndecode_many, lnencode_many, addr_to_dict,
+                    addr_from_dict, get_signer, LnAddr)
 
 import argparse
+import collections
+import contextlib
+import csv
+import json
+import os
+import sys
 import time
 
 
+def parse_route(r):
+    """ Route steps of form pubkey/channel/feebase/feerate/cltv+
+    """
+    splits = r.split('/')
+    route=[]
+    while len(splits) >= 5:
+        route.append((unhexlify(splits[0]),
+                      unhexlify(splits[1]),
+                      int(splits[2]),
+                      int(splits[3]),
+                      int(splits[4])))
+        splits = splits[5:]
+    if len(splits) != 0:
+        raise ValueError("Bad route {}".format(r))
+    return route
+
+
 def encode(options):
     """ Convert options into LnAddr and pass it to the encoder
     """
     addr = LnAddr()
     addr.currency = options.currency
-    addr.fallback = options.fallback if options.fallback else None
-    if options.amount:
-        addr.amount = options.amount
+    if options.amount_msat:
+        addr.amount_msat = options.amount_msat
     if options.timestamp:
         addr.date = int(options.timestamp)
 
@@ -30,22 +53,135 @@ def encode(options):
         addr.tags.append(('f', options.fallback))
 
     for r in options.route:
-        splits = r.split('/')
-        route=[]
-        while len(splits) >= 5:
-            route.append((unhexlify(splits[0]),
-                          unhexlify(splits[1]),
-                          int(splits[2]),
-                          int(splits[3]),
-                          int(splits[4])))
-            splits = splits[5:]
-        assert(len(splits) == 0)
-        addr.tags.append(('r', route))
+        addr.tags.append(('r', parse_route(r)))
     print(lnencode(addr, options.privkey))
 
 
+def open_input(stack, filename, **kwargs):
+    """ FILE, or stdin for '-': closed with stack.
+    """
+    if filename == '-':
+        return sys.stdin
+    return stack.enter_context(open(filename, **kwargs))
+
+
+def process_pool(stack, workers, **kwargs):
+    """ A pool of `workers` processes (None for just one): shut down with stack.
+    """
+    if workers <= 1:
+        return None
+    # Imported here as it's slow to import, and only needed here.
+    from concurrent.futures import ProcessPoolExecutor
+    return stack.enter_context(ProcessPoolExecutor(workers, **kwargs))
+
+
+def batch_records(infile, fmt):
+    """ Records to encode: JSON lines, or dicts of CSV fields.
+
+    Both use addr_from_dict field names.  Empty CSV cells are ignored,
+    and `routes` may hold space-separated routes in --route form.
+    """
+    if fmt == 'csv':
+        for row in csv.DictReader(infile):
+            yield {k: v for k, v in row.items() if k and v}
+    else:
+        for line in infile:
+            if line.strip():
+                yield line
+
+
+def record_to_addr(record, currency):
+    if isinstance(record, str):
+        record = json.loads(record)
+    if not isinstance(record, dict):
+        raise ValueError("Record must be an object")
+    routes = record.get('routes')
+    if isinstance(routes, str):
+        record = dict(record, routes=None)
+    addr = addr_from_dict(dict({'currency': currency}, **record))
+    if isinstance(routes, str):
+        for r in routes.split():
+            addr.tags.append(('r', parse_route(r)))
+    return addr
+
+
+def encode_batch(options):
+    """ Encode JSON-lines or CSV records, writing one JSON object per line.
+    """
+    fmt = options.format
+    if fmt is None:
+        fmt = 'csv' if options.file.endswith('.csv') else 'jsonl'
+
+    with contextlib.ExitStack() as stack:
+        infile = open_input(stack, options.file, newline='')
+        executor = process_pool(stack, options.workers, initializer=get_signer,
+                                initargs=(options.privkey,))
+
+        # Records which can't be turned into an LnAddr never reach the
+        # encoder, so note them (in order) alongside the ones which do.
+        order = collections.deque()
+        def feed():
+            for n, record in enumerate(batch_records(infile, fmt)):
+                try:
+                    addr = record_to_addr(record, options.currency)
+                except Exception as e:
+                    order.append((n, None, e))
+                else:
+                    order.append((n, addr, None))
+                    yield addr
+
+        def flush_errors():
+            while order and order[0][2] is not None:
+                n, addr, e = order.popleft()
+                print(json.dumps({'record': n, 'error': str(e)}))
+
+        for r in lnencode_many(feed(), options.privkey, executor, chunksize=options.chunksize):
+            flush_errors()
+            n, addr, e = order.popleft()
+            out = {'record': n, 'paymenthash': hexlify(addr.paymenthash).decode()}
+            if isinstance(r, Exception):
+                out['error'] = str(r)
+            else:
+                out['invoice'] = r
+            print(json.dumps(out))
+        flush_errors()
+
+
+def decode_stream(options):
+    """ Decode newline-separated invoices, writing one JSON object per line.
+    """
+    with contextlib.ExitStack() as stack:
+        infile = open_input(stack, options.stream)
+        invoices = (line.strip() for line in infile if line.strip())
+        executor = process_pool(stack, options.workers)
+
+        # lndecode_many only reads ahead a bounded number of chunks, and we
+        # need the invoice back to report it, so tee it through a generator.
+        order = collections.deque()
+        def feed():
+            for a in invoices:
+                order.append(a)
+                yield a
+
+        for r in lndecode_many(feed(), executor, chunksize=options.chunksize,
+                               expected_pubkey=options.pubkey):
+            a = order.popleft()
+            if isinstance(r, Exception):
+                out = {'invoice': a, 'error': str(r)}
+            else:
+                out = addr_to_dict(r)
+                out['invoice'] = a
+            print(json.dumps(out))
+
+
 def decode(options):
-    a = lndecode(options.lnaddress, options.verbose)
+    if options.stream:
+        decode_stream(options)
+        return
+    if not options.lnaddress:
+        parser_dec.error("need lnaddress or --stream")
+
+    a = lndecode(options.lnaddress, options.verbose, expected_pubkey=options.pubkey)
     def tags_by_name(name, tags):
         return [t[1] for t in tags if t[0] == name]
 
@@ -81,12 +217,44 @@ def decode(options):
     for t in [t for t in a.tags if t[0] not in 'rdfhx']:
         print("UNKNOWN TAG {}: {}".format(t[0], hexlify(t[1])))
 
+def serve_stdio(options):
+    """ Answer line-delimited JSON requests from stdin, as lnserver does.
+
+    {"method": "stats"} reports the number of requests so far and their
+    p50/p90/p99 latency.
+    """
+    # lnserver pulls in asyncio, which other commands don't need.
+    from lnserver import handle_request, latency_stats
+    requests = 0
+    latencies = collections.deque(maxlen=10000)
+    for line in iter(sys.stdin.readline, ''):
+        if not line.strip():
+            continue
+        start = time.perf_counter()
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            reply = {'id': None, 'error': 'Bad JSON: {}'.format(e)}
+        else:
+            if isinstance(req, dict) and req.get('method') == 'stats':
+                reply = {'id': req.get('id'),
+                         'result': {'requests': requests,
+                                    'latency_ms': latency_stats(latencies)}}
+            else:
+                requests += 1
+                reply = handle_request(req, options.privkey)
+                latencies.append(time.perf_counter() - start)
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
 parser = argparse.ArgumentParser(description='Encode lightning address')
 subparsers = parser.add_subparsers(dest='subparser_name',
                                    help='sub-command help')
 
 parser_enc = subparsers.add_parser('encode', help='encode help')
+parser_batch = subparsers.add_parser('encode-batch', help='Encode records from a file to JSON lines')
 parser_dec = subparsers.add_parser('decode', help='decode help')
+parser_serve = subparsers.add_parser('serve-stdio', help='Encode and decode JSON requests from stdin')
 
 parser_enc.add_argument('--currency', default='bc',
                     help="What currency")
@@ -104,17 +272,40 @@ parser_enc.add_argument('--timestamp', type=int,
                         help='Timestamp (seconds after epoch) instead of now')
 parser_enc.add_argument('--no-amount', action="store_true",
                         help="Don't encode amount")
-parser_enc.add_argument('amount', type=float, help='Amount in currency')
+parser_enc.add_argument('amount_msat', type=int, help='Amount in millisatoshi')
 parser_enc.add_argument('paymenthash', help='Payment hash (in hex)')
 parser_enc.add_argument('privkey', help='Private key (in hex)')
 parser_enc.set_defaults(func=encode)
 
-parser_dec.add_argument('lnaddress', help='Address to decode')
+parser_batch.add_argument('--currency', default='bc',
+                          help="Currency for records which don't give one")
+parser_batch.add_argument('--format', choices=['jsonl', 'csv'],
+                          help='FILE format (default: csv if FILE ends in .csv)')
+parser_batch.add_argument('--workers', type=int, default=os.cpu_count(),
+                          help='Processes to sign records with')
+parser_batch.add_argument('--chunksize', type=int, default=64,
+                          help='Records per worker task')
+parser_batch.add_argument('file', metavar='FILE', help="Records to encode ('-' for stdin)")
+parser_batch.add_argument('privkey', help='Private key (in hex)')
+parser_batch.set_defaults(func=encode_batch)
+
+parser_dec.add_argument('lnaddress', nargs='?', help='Address to decode')
 parser_dec.add_argument('--rate', type=float, help='Convfersion amount for 1 currency unit')
-parser_dec.add_argument('--pubkey', help='Public key for the chanid')
+parser_dec.add_argument('--pubkey',
+                        help='Expected payee public key (in hex): verify against it, rejecting invoices from anyone else')
 parser_dec.add_argument('--verbose', help='Print out extra decoding info', action="store_true")
+parser_dec.add_argument('--stream', metavar='FILE',
+                        help="Decode newline-separated addresses from FILE ('-' for stdin) to JSON lines")
+parser_dec.add_argument('--workers', type=int, default=1,
+                        help='Processes to decode --stream input with')
+parser_dec.add_argument('--chunksize', type=int, default=64,
+                        help='Addresses per worker task in --stream mode')
 parser_dec.set_defaults(func=decode)
 
+parser_serve.add_argument('--privkey',
+                          help='Private key (in hex) to sign encode requests with')
+parser_serve.set_defaults(func=serve_stdio)
+
 if __name__ == "__main__":
     options = parser.parse_args()
     if not options.subparser_name:
@@ -1,28 +1,124 @@
 #! /usr/bin/env python3
 from bech32 import bech32_encode, bech32_decode, CHARSET
 from binascii import hexlify, unhexlify
-from bitstring import BitArray
-from decimal import Decimal
+from lazyimport import lazy_import
+from lnecdsa import get_backend, pubkey_cache
 
-import base58
-import bitstring
+import base64
+import collections
+import decimal
 import hashlib
 import math
-import re
-import secp256k1
+import struct
 import sys
+import threading
 import time
 
+# These are slow to import, and many paths (--help, checksums, decoding
+# without a fallback...) never use some of them, so they're only loaded on
+# first use.
+base58 = lazy_import('base58')
+bitstring = lazy_import('bitstring')
+
+
+# Optional instrumentation: if set (see set_instrumentation), called with a
+# CallStats after every lndecode and lnencode.
+instrument_hook = None
+
+def set_instrumentation(hook):
+    """ Register hook(stats) to be called after each lndecode/lnencode.
+
+    Returns the previous hook; None disables instrumentation.
+    """
+    global instrument_hook
+    old = instrument_hook
+    instrument_hook = hook
+    return old
+
+class CallStats(object):
+    """ Per-call timings (in seconds, by stage) and sizes.
+    """
+    def __init__(self, op):
+        self.op = op
+        self.stages = collections.OrderedDict()
+        self.nbytes = 0
+        self.ntags = 0
+        # Filled in by lndecode.
+        self.sigdecoded = None
+        self.sigdata = None
+        self.last = time.perf_counter()
+
+    # Charge the time since the last lap to stage.
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self.last
+        self.last = now
+
+class Counters(object):
+    """ Instrumentation hook which totals up CallStats, per operation.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.seconds = collections.defaultdict(collections.Counter)
+        self.nbytes = collections.Counter()
+        self.ntags = collections.Counter()
+
+    def __call__(self, stats):
+        with self.lock:
+            self.calls[stats.op] += 1
+            self.seconds[stats.op].update(stats.stages)
+            self.nbytes[stats.op] += stats.nbytes
+            self.ntags[stats.op] += stats.ntags
+
+def print_verbose(stats):
+    print('hex of signature data (32 byte r, 32 byte s): {}'
+          .format(hexlify(stats.sigdecoded[0:64])))
+    print('recovery flag: {}'.format(stats.sigdecoded[64]))
+    print('hex of data for signing: {}'
+          .format(hexlify(stats.sigdata)))
+    print('SHA256 of above: {}'.format(hashlib.sha256(stats.sigdata).hexdigest()))
+
+MSAT_PER_BTC = 10**11
+
+# BOLT #11:
+# The following `multiplier` letters are defined:
+#
+#* `m` (milli): multiply by 0.001
+#* `u` (micro): multiply by 0.000001
+#* `n` (nano): multiply by 0.000000001
+#* `p` (pico): multiply by 0.000000000001
+#
+# Here as millisatoshi per unit (`p` is a tenth of one, so is special).
+MSAT_PER_UNIT = {
+    'm': 10**8,
+    'u': 10**5,
+    'n': 10**2,
+}
+
+def amount_to_msat(amount):
+    """ Given an amount in bitcoin (or None), convert it to millisatoshi
+    """
+    if amount is None:
+        return None
+    if isinstance(amount, int):
+        return amount * MSAT_PER_BTC
+    msat = decimal.Decimal(str(amount)) * MSAT_PER_BTC
+    # We can only send down to millisatoshi.
+    if msat % 1:
+        raise ValueError("Cannot encode {}: too many decimal places".format(
+            amount))
+    return int(msat)
 
 # BOLT #11:
 #
 # A writer MUST encode `amount` as a positive decimal integer with no
 # leading zeroes, SHOULD use the shortest representation possible.
-def shorten_amount(amount):
-    """ Given an amount in bitcoin, shorten it
+def shorten_msat(msat):
+    """ Given an amount in millisatoshi, shorten it
     """
     # Convert to pico initially
-    amount = int(amount * 10**12)
+    amount = msat * 10
     units = ['p', 'n', 'u', 'm', '']
     for unit in units:
         if amount % 1000 == 0:
@@ -31,33 +127,36 @@ def shorten_amount(amount):
             break
     return str(amount) + unit
 
-def unshorten_amount(amount):
-    """ Given a shortened amount, convert it into a decimal
+def unshorten_msat(amount):
+    """ Given a shortened amount, convert it into millisatoshi
     """
-    # BOLT #11:
-    # The following `multiplier` letters are defined:
-    #
-    #* `m` (milli): multiply by 0.001
-    #* `u` (micro): multiply by 0.000001
-    #* `n` (nano): multiply by 0.000000001
-    #* `p` (pico): multiply by 0.000000000001
-    units = {
-        'p': 10**12,
-        'n': 10**9,
-        'u': 10**6,
-        'm': 10**3,
-    }
-    unit = str(amount)[-1]
+    unit = amount[-1:]
+    digits = amount[:-1] if unit in MSAT_PER_UNIT or unit == 'p' else amount
     # BOLT #11:
     # A reader SHOULD fail if `amount` contains a non-digit, or is followed by
     # anything except a `multiplier` in the table above.
-    if not re.fullmatch("\d+[pnum]?", str(amount)):
+    if not (digits.isascii() and digits.isdigit()):
         raise ValueError("Invalid amount '{}'".format(amount))
 
-    if unit in units.keys():
-        return Decimal(amount[:-1]) / units[unit]
-    else:
-        return Decimal(amount)
+    if unit == 'p':
+        # BOLT #11:
+        # if the `multiplier` is present and is `p`, and the last decimal
+        # of `amount` is not 0: MUST fail the payment request.
+        if digits[-1] != '0':
+            raise ValueError("Invalid amount '{}': not a whole number of "
+                             "millisatoshi".format(amount))
+        return int(digits) // 10
+    return int(digits) * MSAT_PER_UNIT.get(unit, MSAT_PER_BTC)
+
+def shorten_amount(amount):
+    """ Given an amount in bitcoin, shorten it
+    """
+    return shorten_msat(amount_to_msat(amount))
+
+def unshorten_amount(amount):
+    """ Given a shortened amount, convert it into a decimal
+    """
+    return decimal.Decimal(unshorten_msat(str(amount))) / MSAT_PER_BTC
 
 # Bech32 spits out array of 5-bit values.  Shim here.
 def u5_to_bitarray(arr):
@@ -74,8 +173,68 @@ def bitarray_to_u5(barr):
         ret.append(s.read(5).uint)
     return ret
 
-def encode_fallback(fallback, currency):
-    """ Encode all supported fallback addresses.
+# Decoding works on plain integers instead: int(..., 32) packs a whole run
+# of 5-bit values in one go.
+U5_DIGITS = bytes.maketrans(bytes(range(32)), b'0123456789abcdefghijklmnopqrstuv')
+
+def u5_to_int(arr):
+    if not arr:
+        return 0
+    return int(bytes(arr).translate(U5_DIGITS), 32)
+
+# For callers which still want bitstrings (see UnknownTag.bitstream).
+def int_to_bitstream(value, nbits):
+    if nbits == 0:
+        return bitstring.ConstBitStream()
+    return bitstring.ConstBitStream(uint=value, length=nbits)
+
+# Discard trailing bits of an nbits-long integer, convert to bytes.
+def int_to_trimmed_bytes(value, nbits):
+    return (value >> (nbits % 8)).to_bytes(nbits // 8, 'big')
+
+# Zero-pad an nbits-long integer on the right to a whole number of bytes.
+def int_to_padded_bytes(value, nbits):
+    pad = -nbits % 8
+    return (value << pad).to_bytes((nbits + pad) // 8, 'big')
+
+# Base32 (RFC 4648) splits bytes into zero-padded 5-bit groups exactly as
+# BOLT #11 does, just with a different alphabet.
+B32_TO_U5 = bytes.maketrans(b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567', bytes(range(32)))
+
+def bytes_to_u5(b):
+    return list(base64.b32encode(b).rstrip(b'=').translate(B32_TO_U5))
+
+# Route hop layout within an `r` field.
+ROUTE_HOP = struct.Struct('>33s8siih')
+
+class U5Writer(object):
+    """ Accumulates the data part of an invoice as 5-bit values.
+    """
+    def __init__(self):
+        self.u5 = []
+
+    def uint(self, value, nbits):
+        assert nbits % 5 == 0
+        for shift in range(nbits - 5, -5, -5):
+            self.u5.append((value >> shift) & 31)
+
+    # Tagged field containing 5-bit values.
+    def tagged(self, char, u5):
+        if len(u5) >= 1024:
+            raise ValueError("Field '{}' too long".format(char))
+        self.u5 += [CHARSET.find(char), len(u5) // 32, len(u5) % 32]
+        self.u5 += u5
+
+    # Tagged field containing bytes: zero-padded to 5 bits.
+    def tagged_bytes(self, char, b):
+        self.tagged(char, bytes_to_u5(b))
+
+    # Data as signed: padded to 8 bits with zeroes.
+    def tobytes(self):
+        return int_to_padded_bytes(u5_to_int(self.u5), len(self.u5) * 5)
+
+def fallback_to_u5(fallback, currency):
+    """ Encode all supported fallback addresses, as version then program.
     """
     if currency == 'bc' or currency == 'tb':
         fbhrp, witness = bech32_decode(fallback)
@@ -85,7 +244,7 @@ def encode_fallback(fallback, currency):
             wver = witness[0]
             if wver > 16:
                 raise ValueError("Invalid witness version {}".format(witness[0]))
-            wprog = u5_to_bitarray(witness[1:])
+            wprog = witness[1:]
         else:
             addr = base58.b58decode_check(fallback)
             if is_p2pkh(currency, addr[0]):
@@ -94,26 +253,33 @@ def encode_fallback(fallback, currency):
                 wver = 18
             else:
                 raise ValueError("Unknown address type for {}".format(currency))
-            wprog = addr[1:]
-        return tagged('f', bitstring.pack("uint:5", wver) + wprog)
+            wprog = bytes_to_u5(addr[1:])
+        return [wver] + wprog
     else:
         raise NotImplementedError("Support for currency {} not implemented".format(currency))
 
+def encode_fallback(fallback, currency):
+    return tagged('f', u5_to_bitarray(fallback_to_u5(fallback, currency)))
+
 def parse_fallback(fallback, currency):
+    return parse_fallback_u5(bitarray_to_u5(fallback), currency)
+
+def parse_fallback_u5(fallback, currency):
     if currency == 'bc' or currency == 'tb':
-        wver = fallback[0:5].uint
-        if wver == 17:
-            addr=base58.b58encode_check(bytes([base58_prefix_map[currency][0]])
-                                        + fallback[5:].tobytes())
-        elif wver == 18:
-            addr=base58.b58encode_check(bytes([base58_prefix_map[currency][1]])
-                                        + fallback[5:].tobytes())
+        if not fallback:
+            return None
+        wver = fallback[0]
+        if wver == 17 or wver == 18:
+            prefix = base58_prefix_map[currency][wver - 17]
+            addr=base58.b58encode_check(bytes([prefix])
+                                        + int_to_padded_bytes(u5_to_int(fallback[1:]),
+                                                              len(fallback[1:]) * 5))
         elif wver <= 16:
-            addr=bech32_encode(currency, bitarray_to_u5(fallback))
+            addr=bech32_encode(currency, fallback)
         else:
             return None
     else:
-        addr=fallback.tobytes()
+        addr=int_to_padded_bytes(u5_to_int(fallback), len(fallback) * 5)
     return addr
 
 
@@ -156,28 +322,34 @@ def pull_tagged(stream):
     length = stream.read(5).uint * 32 + stream.read(5).uint
     return (CHARSET[tag], stream.read(length * 5), stream)
 
-def lnencode(addr, privkey):
-    if addr.amount:
-        amount = Decimal(str(addr.amount))
-        # We can only send down to millisatoshi.
-        if amount * 10**12 % 10:
-            raise ValueError("Cannot encode {}: too many decimal places".format(
-                addr.amount))
-
-        amount = addr.currency + shorten_amount(amount)
-    else:
-        amount = addr.currency if addr.currency else ''
+def encode_hrp(currency, amount_msat):
+    hrp = 'ln' + (currency if currency else '')
+    if amount_msat:
+        hrp += shorten_msat(amount_msat)
+    return hrp
 
-    hrp = 'ln' + amount
+def lnencode_unsigned(addr, stats=None):
+    """ Returns hrp and (unsigned) data for addr.
+    """
+    hrp = encode_hrp(addr.currency, addr.amount_msat)
 
     # Start with the timestamp
-    data = bitstring.pack('uint:35', addr.date)
+    data = U5Writer()
+    data.uint(addr.date, 35)
 
     # Payment hash
-    data += tagged_bytes('p', addr.paymenthash)
-    tags_set = set()
+    data.tagged_bytes('p', addr.paymenthash)
+    if stats:
+        stats.lap('tags')
 
-    for k, v in addr.tags:
+    encode_tags(data, addr.tags, addr.currency, stats)
+    return hrp, data
+
+def encode_tags(data, tags, currency, stats=None):
+    """ Append the tagged fields other than `p` to a U5Writer.
+    """
+    tags_set = set()
+    for k, v in tags:
 
         # BOLT #11:
         #
@@ -187,30 +359,36 @@ def lnencode(addr, privkey):
                 raise ValueError("Duplicate '{}' tag".format(k))
 
         if k == 'r':
-            route = bitstring.BitArray()
+            route = bytearray()
             for step in v:
                 pubkey, channel, feebase, feerate, cltv = step
-                route.append(bitstring.BitArray(pubkey) + bitstring.BitArray(channel) + bitstring.pack('intbe:32', feebase) + bitstring.pack('intbe:32', feerate) + bitstring.pack('intbe:16', cltv))
-            data += tagged('r', route)
+                if len(pubkey) != 33 or len(channel) != 8:
+                    raise ValueError("Invalid route step {}".format(step))
+                route += ROUTE_HOP.pack(pubkey, channel, feebase, feerate, cltv)
+            data.tagged_bytes('r', route)
         elif k == 'f':
-            data += encode_fallback(v, addr.currency)
+            data.tagged('f', fallback_to_u5(v, currency))
         elif k == 'd':
-            data += tagged_bytes('d', v.encode())
+            data.tagged_bytes('d', v.encode())
         elif k == 'x':
             # Get minimal length by trimming leading 5 bits at a time.
-            expirybits = bitstring.pack('intbe:64', v)[4:64]
-            while expirybits.startswith('0b00000'):
-                expirybits = expirybits[5:]
-            data += tagged('x', expirybits)
+            expiry = v & ((1 << 60) - 1)
+            expirybits = []
+            while expiry:
+                expirybits.insert(0, expiry & 31)
+                expiry >>= 5
+            data.tagged('x', expirybits)
         elif k == 'h':
-            data += tagged_bytes('h', hashlib.sha256(v.encode('utf-8')).digest())
+            data.tagged_bytes('h', hashlib.sha256(v.encode('utf-8')).digest())
         elif k == 'n':
-            data += tagged_bytes('n', v)
+            data.tagged_bytes('n', v)
         else:
             # FIXME: Support unknown tags?
             raise ValueError("Unknown tag {}".format(k))
 
         tags_set.add(k)
+        if stats:
+            stats.lap('fallback' if k == 'f' else 'tags')
 
     # BOLT #11:
     #
@@ -220,26 +398,138 @@ def lnencode(addr, privkey):
         raise ValueError("Cannot include both 'd' and 'h'")
     if not 'd' in tags_set and not 'h' in tags_set:
         raise ValueError("Must include either 'd' or 'h'")
-    
-    # We actually sign the hrp, then data (padded to 8 bits with zeroes).
-    privkey = secp256k1.PrivateKey(bytes(unhexlify(privkey)))
-    sig = privkey.ecdsa_sign_recoverable(bytearray([ord(c) for c in hrp]) + data.tobytes())
-    # This doesn't actually serialize, but returns a pair of values :(
-    sig, recid = privkey.ecdsa_recoverable_serialize(sig)
-    data += bytes(sig) + bytes([recid])
 
-    return bech32_encode(hrp, bitarray_to_u5(data))
+class InvoiceSigner(object):
+    """ Encodes and signs invoices with a single private key.
+
+    The key (hex) is parsed once, rather than on every lnencode call.
+    """
+    def __init__(self, privkey):
+        self.backend = get_backend()
+        self.privkey = self.backend.privkey(unhexlify(privkey))
+
+    # Returns the signature (and recovery id) as 5-bit values.
+    def sign(self, hrp, data):
+        # We actually sign the hrp, then data (padded to 8 bits with zeroes).
+        sig, recid = self.backend.sign_recoverable(
+            self.privkey, bytearray([ord(c) for c in hrp]) + data.tobytes())
+        return bytes_to_u5(sig + bytes([recid]))
+
+    def encode(self, addr):
+        stats = CallStats('lnencode') if instrument_hook else None
+        hrp, data = lnencode_unsigned(addr, stats)
+        sig = self.sign(hrp, data)
+        if stats:
+            stats.lap('signature')
+        ret = bech32_encode(hrp, data.u5 + sig)
+        if stats:
+            stats.lap('bech32')
+            stats.nbytes = len(ret)
+            stats.ntags = len(addr.tags) + 1
+            instrument_hook(stats)
+        return ret
+
+    def encode_many(self, addrs):
+        return [self.encode(addr) for addr in addrs]
+
+def lnencode(addr, privkey):
+    return InvoiceSigner(privkey).encode(addr)
+
+# InvoiceSigners for the most recently used private keys, per process (so
+# worker processes parse each key once, however many tasks they run).
+# Bounded, so a long-lived process doesn't hold on to every key it has
+# ever signed with.
+MAX_SIGNERS = 16
+signers = collections.OrderedDict()
+signers_lock = threading.Lock()
+
+def get_signer(privkey):
+    with signers_lock:
+        signer = signers.get(privkey)
+        if signer is not None:
+            signers.move_to_end(privkey)
+            return signer
+    signer = InvoiceSigner(privkey)
+    with signers_lock:
+        signers[privkey] = signer
+        while len(signers) > MAX_SIGNERS:
+            signers.popitem(last=False)
+    return signer
+
+class InvoiceTemplate(object):
+    """ Invoices which differ only in payment hash, amount and date.
+
+    The other tags are encoded (and checked) once, up front: encode()
+    gives the same invoice as lnencode would for an LnAddr with these
+    tags.
+    """
+    def __init__(self, signer, tags, currency='bc'):
+        self.signer = signer
+        self.currency = currency
+        self.tags = list(tags)
+        data = U5Writer()
+        encode_tags(data, self.tags, currency)
+        self.tags_u5 = data.u5
+
+    def encode(self, paymenthash, amount_msat=None, date=None):
+        hrp = encode_hrp(self.currency, amount_msat)
+        data = U5Writer()
+        data.uint(int(time.time()) if not date else int(date), 35)
+        data.tagged_bytes('p', paymenthash)
+        data.u5 += self.tags_u5
+        return bech32_encode(hrp, data.u5 + self.signer.sign(hrp, data))
+
+DEFAULT_EXPIRY = 3600
+
+# `r` field entries, as (pubkey, short_channel_id, feebase, feerate, cltv).
+class RouteHop(collections.namedtuple('RouteHop', ['pubkey', 'short_channel_id',
+                                                   'feebase', 'feerate', 'cltv'])):
+    __slots__ = ()
+
+# Fields we skipped: payload is zero-padded to bytes, bits is its real length.
+class UnknownTag(collections.namedtuple('UnknownTag', ['tag', 'data', 'bits'])):
+    __slots__ = ()
+
+    def bitstream(self):
+        return int_to_bitstream(int.from_bytes(self.data, 'big') >> (-self.bits % 8), self.bits)
 
 class LnAddr(object):
-    def __init__(self, paymenthash=None, amount=None, currency='bc', tags=None, date=None):
+    __slots__ = ('date', 'tags', 'unknown_tags', 'paymenthash', 'compact_signature',
+                 'pubkey', 'currency', 'amount_msat')
+
+    def __init__(self, paymenthash=None, amount=None, currency='bc', tags=None, date=None,
+                 amount_msat=None):
         self.date = int(time.time()) if not date else int(date)
         self.tags = [] if not tags else tags
         self.unknown_tags = []
         self.paymenthash=paymenthash
-        self.signature = None
+        self.compact_signature = None
         self.pubkey = None
         self.currency = currency
-        self.amount = amount
+        self.amount_msat = amount_msat
+        if amount is not None:
+            self.amount = amount
+
+    # The amount in bitcoin, as a Decimal.  amount_msat is what's stored.
+    @property
+    def amount(self):
+        if self.amount_msat is None:
+            return None
+        return decimal.Decimal(self.amount_msat) / MSAT_PER_BTC
+
+    @amount.setter
+    def amount(self, amount):
+        self.amount_msat = amount_to_msat(amount)
+
+    # BOLT #11:
+    #
+    # `x` (6): `data_length` variable.  `expiry` time in seconds
+    # (big-endian). Default is 3600 (1 hour) if not specified.
+    def get_expiry(self):
+        for k, v in self.tags:
+            if k == 'x':
+                return v
+        return DEFAULT_EXPIRY
 
     def __str__(self):
         return "LnAddr[{}, amount={}{} tags=[{}]]".format(
@@ -248,7 +538,50 @@ class LnAddr(object):
             ", ".join([k + '=' + str(v) for k, v in self.tags])
         )
 
-def lndecode(a, verbose=False):
+    # The signature as the ECDSA backend's object: with secp256k1, the
+    # cffi signature its PublicKey methods take.  compact_signature is
+    # what's stored.
+    @property
+    def signature(self):
+        if self.compact_signature is None:
+            return None
+        return get_backend().signature(self.pubkey, *self.compact_signature)
+
+    @signature.setter
+    def signature(self, signature):
+        if signature is not None:
+            signature = get_backend().serialize_signature(self.pubkey, signature)
+        self.compact_signature = signature
+
+    # Returns 64-byte compact signature and recovery id (None if we
+    # verified against `n` rather than recovering).
+    def serialize_signature(self):
+        sig, recid = self.compact_signature
+        return bytes(sig), recid
+
+    # Public keys are the ECDSA backend's objects (often cffi ones), so
+    # pickle (e.g. for a process pool) them in serialized form.
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                try:
+                    state[name] = getattr(self, name)
+                except AttributeError:
+                    pass
+        if state.get('pubkey') is not None:
+            state['pubkey'] = self.pubkey.serialize()
+        return state
+
+    def __setstate__(self, state):
+        if state.get('pubkey') is not None:
+            state['pubkey'] = pubkey_cache.get(state['pubkey'])
+        for k, v in state.items():
+            object.__setattr__(self, k, v)
+
+def split_invoice(a):
+    """ Check bech32 checksum and prefix: returns hrp, data and signature.
+    """
     hrp, data = bech32_decode(a)
     if not hrp:
         raise ValueError("Bad bech32 checksum")
@@ -259,106 +592,117 @@ def lndecode(a, verbose=False):
     if not hrp.startswith('ln'):
         raise ValueError("Does not start with ln")
 
-    data = u5_to_bitarray(data);
-
-    # Final signature 65 bytes, split it off.
-    if len(data) < 65*8:
+    # Final signature 65 bytes (104 5-bit values), split it off.
+    if len(data) < 104:
         raise ValueError("Too short to contain signature")
-    sigdecoded = data[-65*8:].tobytes()
-    data = bitstring.ConstBitStream(data[:-65*8])
+    # One buffer of 5-bit values: fields are parsed from memoryview slices.
+    data = bytes(data)
+    sigdecoded = u5_to_int(data[-104:]).to_bytes(65, 'big')
+    return hrp, data[:-104], sigdecoded
 
-    addr = LnAddr()
-    addr.pubkey = None
-
-    m = re.search("[^\d]+", hrp[2:])
-    if m:
-        addr.currency = m.group(0)
-        amountstr = hrp[2+m.end():]
+def parse_hrp(addr, hrp):
+    # The currency runs up to the first digit of the amount (if any).
+    end = 2
+    while end < len(hrp) and not hrp[end].isdigit():
+        end += 1
+    if end > 2:
+        addr.currency = hrp[2:end]
+        amountstr = hrp[end:]
         # BOLT #11:
         #
         # A reader SHOULD indicate if amount is unspecified, otherwise it MUST
         # multiply `amount` by the `multiplier` value (if any) to derive the
         # amount required for payment.
         if amountstr != '':
-            addr.amount = unshorten_amount(amountstr)
+            addr.amount_msat = unshorten_msat(amountstr)
 
-    addr.date = data.read(35).uint
+# Returns (tag, start, end) for each tagged field after the timestamp.
+def tag_offsets(data):
+    if len(data) < 7:
+        raise ValueError("Too short to contain timestamp")
 
-    while data.pos != data.len:
-        tag, tagdata, data = pull_tagged(data)
+    offsets = []
+    pos = 7
+    while pos != len(data):
+        if pos + 3 > len(data):
+            raise ValueError("Truncated tagged field")
+        tag = CHARSET[data[pos]]
+        data_length = data[pos + 1] * 32 + data[pos + 2]
+        pos += 3
+        if pos + data_length > len(data):
+            raise ValueError("Truncated '{}' field".format(tag))
+        offsets.append((tag, pos, pos + data_length))
+        pos += data_length
+    return offsets
 
+# Parse one tagged field (a sequence of 5-bit values) into addr.
+def parse_field(addr, tag, tagdata):
+    # The payload as an integer of nbits bits.
+    data_length = len(tagdata)
+    value = u5_to_int(tagdata)
+    nbits = data_length * 5
+
+    # BOLT #11:
+    #
+    # A reader MUST skip over unknown fields, an `f` field with unknown
+    # `version`, or a `p`, `h`, or `n` field which does not have
+    # `data_length` 52, 52, or 53 respectively.
+    if tag == 'r':
         # BOLT #11:
         #
-        # A reader MUST skip over unknown fields, an `f` field with unknown
-        # `version`, or a `p`, `h`, or `n` field which does not have
-        # `data_length` 52, 52, or 53 respectively.
-        data_length = len(tagdata) / 5
-        
-        if tag == 'r':
-            # BOLT #11:
-            #
-            # * `r` (3): `data_length` variable.  One or more entries
-            # containing extra routing information for a private route;
-            # there may be more than one `r` field, too.
-            #    * `pubkey` (264 bits)
-            #    * `short_channel_id` (64 bits)
-            #    * `feebase` (32 bits, big-endian)
-            #    * `feerate` (32 bits, big-endian)
-            #    * `cltv_expiry_delta` (16 bits, big-endian)
-            route=[]
-            s = bitstring.ConstBitStream(tagdata)
-            while s.pos + 264 + 64 + 32 + 32 + 16 < s.len:
-                route.append((s.read(264).tobytes(),
-                              s.read(64).tobytes(),
-                              s.read(32).intbe,
-                              s.read(32).intbe,
-                              s.read(16).intbe))
-            addr.tags.append(('r',route))                
-        elif tag == 'f':
-            fallback = parse_fallback(tagdata, addr.currency)
-            if fallback:
-                addr.tags.append(('f', fallback))
-            else:
-                # Incorrect version.
-                addr.unknown_tags.append((tag, tagdata))
-                continue
-
-        elif tag == 'd':
-            addr.tags.append(('d', trim_to_bytes(tagdata).decode('utf-8')))
-
-        elif tag == 'h':
-            if data_length != 52:
-                addr.unknown_tags.append((tag, tagdata))
-                continue
-            addr.tags.append(('h', trim_to_bytes(tagdata)))
-
-        elif tag == 'x':
-            addr.tags.append(('x', tagdata.uint))
-
-        elif tag == 'p':
-            if data_length != 52:
-                addr.unknown_tags.append((tag, tagdata))
-                continue
-            addr.paymenthash = trim_to_bytes(tagdata)
-
-        elif tag == 'n':
-            if data_length != 53:
-                addr.unknown_tags.append((tag, tagdata))
-                continue
-            addr.pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
-            addr.pubkey.deserialize(trim_to_bytes(tagdata))
+        # * `r` (3): `data_length` variable.  One or more entries
+        # containing extra routing information for a private route;
+        # there may be more than one `r` field, too.
+        #    * `pubkey` (264 bits)
+        #    * `short_channel_id` (64 bits)
+        #    * `feebase` (32 bits, big-endian)
+        #    * `feerate` (32 bits, big-endian)
+        #    * `cltv_expiry_delta` (16 bits, big-endian)
+        hops = int_to_trimmed_bytes(value, nbits)
+        route = [RouteHop._make(ROUTE_HOP.unpack_from(hops, off))
+                 for off in range(0, len(hops) - ROUTE_HOP.size + 1, ROUTE_HOP.size)]
+        addr.tags.append(('r',route))
+    elif tag == 'f':
+        fallback = parse_fallback_u5(list(tagdata), addr.currency)
+        if fallback:
+            addr.tags.append(('f', fallback))
         else:
-            addr.unknown_tags.append((tag, tagdata))
+            # Incorrect version.
+            addr.unknown_tags.append(UnknownTag(tag, int_to_padded_bytes(value, nbits), nbits))
 
-    if verbose:
-        print('hex of signature data (32 byte r, 32 byte s): {}'
-              .format(hexlify(sigdecoded[0:64])))
-        print('recovery flag: {}'.format(sigdecoded[64]))
-        print('hex of data for signing: {}'
-              .format(hexlify(bytearray([ord(c) for c in hrp])
-                              + data.tobytes())))
-        print('SHA256 of above: {}'.format(hashlib.sha256(bytearray([ord(c) for c in hrp]) + data.tobytes()).hexdigest()))
+    elif tag == 'd':
+        addr.tags.append(('d', int_to_trimmed_bytes(value, nbits).decode('utf-8')))
+
+    elif tag == 'h':
+        if data_length != 52:
+            addr.unknown_tags.append(UnknownTag(tag, int_to_padded_bytes(value, nbits), nbits))
+            return
+        addr.tags.append(('h', int_to_trimmed_bytes(value, nbits)))
 
+    elif tag == 'x':
+        addr.tags.append(('x', value))
+
+    elif tag == 'p':
+        if data_length != 52:
+            addr.unknown_tags.append(UnknownTag(tag, int_to_padded_bytes(value, nbits), nbits))
+            return
+        addr.paymenthash = int_to_trimmed_bytes(value, nbits)
+
+    elif tag == 'n':
+        if data_length != 53:
+            addr.unknown_tags.append(UnknownTag(tag, int_to_padded_bytes(value, nbits), nbits))
+            return
+        addr.pubkey = pubkey_cache.get(int_to_trimmed_bytes(value, nbits))
+    else:
+        addr.unknown_tags.append(UnknownTag(tag, int_to_padded_bytes(value, nbits), nbits))
+
+# We sign the hrp, then data (padded to 8 bits with zeroes).
+def signing_data(hrp, data):
+    return (bytearray([ord(c) for c in hrp])
+            + int_to_padded_bytes(u5_to_int(data), len(data) * 5))
+
+# Sets addr.compact_signature, and addr.pubkey if it wasn't given by `n`.
+def check_signature(addr, sigdata, sigdecoded):
     # BOLT #11:
     #
     # A reader MUST check that the `signature` is valid (see the `n` tagged
@@ -368,14 +712,382 @@ def lndecode(a, verbose=False):
         #
         # A reader MUST use the `n` field to validate the signature instead of
         # performing signature recovery if a valid `n` field is provided.
-        addr.signature = addr.pubkey.ecdsa_deserialize_compact(sigdecoded[0:64])
-        if not addr.pubkey.ecdsa_verify(bytearray([ord(c) for c in hrp]) + data.tobytes(), addr.signature):
+        if not get_backend().verify(addr.pubkey, sigdata, sigdecoded[0:64]):
             raise ValueError('Invalid signature')
+        addr.compact_signature = (sigdecoded[0:64], None)
     else: # Recover pubkey from signature.
-        addr.pubkey = secp256k1.PublicKey(flags=secp256k1.ALL_FLAGS)
-        addr.signature = addr.pubkey.ecdsa_recoverable_deserialize(
-            sigdecoded[0:64], sigdecoded[64])
-        addr.pubkey.public_key = addr.pubkey.ecdsa_recover(
-            bytearray([ord(c) for c in hrp]) + data.tobytes(), addr.signature)
+        addr.pubkey = get_backend().recover(sigdata, sigdecoded[0:64], sigdecoded[64])
+        addr.compact_signature = (sigdecoded[0:64], sigdecoded[64])
+
+# Fields which can be projected by lndecode(fields=...).
+LAZY_FIELDS = ('currency', 'amount', 'amount_msat', 'date', 'paymenthash', 'tags',
+               'unknown_tags', 'pubkey', 'signature', 'compact_signature')
+
+# Fields which are properties, and the slot each is computed from.
+STORED_AS = {'amount': 'amount_msat', 'signature': 'compact_signature'}
+
+class LazyLnAddr(LnAddr):
+    """ LnAddr which parses fields the first time they are accessed.
+
+    Only the checksum and tag layout are checked up front: the signature
+    is not checked until verify() is called.  If the payee's key is given
+    (as expected_pubkey, or by `n`), pubkey is simply that key; otherwise
+    accessing pubkey (or signature) recovers it from the signature.  If
+    `fields` is given, only those fields can be accessed.
+    """
+    __slots__ = ('raw', 'fields', 'expected_pubkey')
+
+    def __init__(self, hrp, data, sigdecoded, offsets, fields=None, expected_pubkey=None):
+        # Deliberately doesn't call LnAddr.__init__: __getattr__ fills in
+        # whatever is missing on demand.
+        self.raw = (hrp, data, sigdecoded, offsets)
+        self.fields = fields
+        # Serialized, so this pickles.
+        self.expected_pubkey = expected_pubkey
+
+    def __getattr__(self, name):
+        # Only called for attributes which aren't set (yet).
+        if name not in LAZY_FIELDS:
+            raise AttributeError(name)
+        if self.fields is not None and name not in self.fields:
+            # amount and signature are derived from amount_msat and
+            # compact_signature, so either allows both.
+            if not any(name == STORED_AS.get(f) for f in self.fields):
+                raise AttributeError("Field '{}' was not decoded".format(name))
+
+        hrp, data, sigdecoded, offsets = self.raw
+        if name in ('currency', 'amount', 'amount_msat'):
+            addr = LnAddr()
+            parse_hrp(addr, hrp)
+            self.currency, self.amount_msat = addr.currency, addr.amount_msat
+        elif name == 'date':
+            self.date = u5_to_int(data[0:7])
+        elif name == 'paymenthash':
+            self.paymenthash = None
+            for tag, start, end in offsets:
+                if tag == 'p' and end - start == 52:
+                    self.paymenthash = int_to_trimmed_bytes(u5_to_int(data[start:end]), 52 * 5)
+        elif name in ('tags', 'unknown_tags'):
+            addr = LnAddr()
+            parse_hrp(addr, hrp)
+            view = memoryview(data)
+            for tag, start, end in offsets:
+                # Valid `n` only affects the pubkey.
+                if tag != 'n' or end - start != 53:
+                    parse_field(addr, tag, view[start:end])
+            self.tags, self.unknown_tags = addr.tags, addr.unknown_tags
+        elif name in ('pubkey', 'signature', 'compact_signature'):
+            self.check_signature(verify=False)
+        return object.__getattribute__(self, name)
+
+    def is_decoded(self, name):
+        try:
+            object.__getattribute__(self, STORED_AS.get(name, name))
+        except AttributeError:
+            return False
+        return True
+
+    def n_pubkey(self):
+        hrp, data, sigdecoded, offsets = self.raw
+        addr = LnAddr()
+        addr.pubkey = None
+        for tag, start, end in offsets:
+            if tag == 'n' and end - start == 53:
+                parse_field(addr, tag, data[start:end])
+        return addr.pubkey
+
+    def check_signature(self, verify):
+        hrp, data, sigdecoded, offsets = self.raw
+        addr = LnAddr()
+        if self.expected_pubkey is not None:
+            addr.pubkey = pubkey_cache.get(self.expected_pubkey)
+        else:
+            addr.pubkey = self.n_pubkey()
+        if addr.pubkey and not verify:
+            addr.compact_signature = (sigdecoded[0:64], None)
+        else:
+            check_signature(addr, signing_data(hrp, data), sigdecoded)
+        self.pubkey, self.compact_signature = addr.pubkey, addr.compact_signature
+
+    def verify(self):
+        """ Check the signature, raising ValueError if it is invalid.
+        """
+        self.check_signature(verify=True)
+
+# Serialization of a public key given as hex, bytes or a key object.
+def pubkey_bytes(pubkey):
+    if isinstance(pubkey, str):
+        return unhexlify(pubkey)
+    if isinstance(pubkey, (bytes, bytearray)):
+        return bytes(pubkey)
+    return pubkey.serialize()
+
+# Rejects an invoice whose `n` isn't the expected payee, before anything
+# is parsed or checked.
+def check_payee(data, offsets, expected_pubkey):
+    for tag, start, end in offsets:
+        if tag == 'n' and end - start == 53:
+            if int_to_trimmed_bytes(u5_to_int(data[start:end]), 53 * 5) != expected_pubkey:
+                raise ValueError("Payee is not the expected public key")
+
+def lndecode(a, verbose=False, lazy=False, fields=None, expected_pubkey=None):
+    """ Decode and check an invoice, returning an LnAddr.
+
+    If the payee is known, pass its public key (hex, bytes or key object)
+    as expected_pubkey: the signature is then verified against it, which
+    is cheaper than recovering the key, and an invoice from anyone else
+    is rejected.
+    """
+    stats = CallStats('lndecode') if instrument_hook or verbose else None
+    hrp, data, sigdecoded = split_invoice(a)
+    if stats:
+        stats.lap('bech32')
+        stats.nbytes = len(a)
+        stats.sigdecoded = sigdecoded
+    offsets = tag_offsets(data)
+    if stats:
+        stats.lap('unpack')
+        stats.ntags = len(offsets)
+
+    if expected_pubkey is not None:
+        expected_pubkey = pubkey_bytes(expected_pubkey)
+        check_payee(data, offsets, expected_pubkey)
+
+    if lazy or fields is not None:
+        if fields is not None:
+            for f in fields:
+                if f not in LAZY_FIELDS:
+                    raise ValueError("Unknown field '{}'".format(f))
+        if verbose:
+            stats.sigdata = signing_data(hrp, data)
+            print_verbose(stats)
+        addr = LazyLnAddr(hrp, data, sigdecoded, offsets, fields, expected_pubkey)
+        for f in fields or []:
+            getattr(addr, f)
+        if instrument_hook and stats:
+            stats.lap('tags')
+            instrument_hook(stats)
+        return addr
+
+    addr = LnAddr()
+    addr.pubkey = None
+    parse_hrp(addr, hrp)
+    addr.date = u5_to_int(data[0:7])
+
+    view = memoryview(data)
+    for tag, start, end in offsets:
+        parse_field(addr, tag, view[start:end])
+        if stats:
+            stats.lap('fallback' if tag == 'f' else 'tags')
+
+    # Verified against rather than recovered; `n` (if any) is the same key.
+    if expected_pubkey is not None:
+        addr.pubkey = pubkey_cache.get(expected_pubkey)
 
+    sigdata = signing_data(hrp, data)
+
+    if verbose:
+        stats.sigdata = sigdata
+        print_verbose(stats)
+
+    check_signature(addr, sigdata, sigdecoded)
+    if instrument_hook and stats:
+        stats.lap('signature')
+        stats.sigdata = sigdata
+        instrument_hook(stats)
     return addr
+
+# Levels for validate().
+VALIDATE_CHECKSUM = 1
+VALIDATE_STRUCTURE = 2
+VALIDATE_SIGNATURE = 3
+
+def validate(a, level=VALIDATE_SIGNATURE):
+    """ Check an invoice without building an LnAddr: raises ValueError if bad.
+
+    VALIDATE_CHECKSUM only checks the bech32 checksum.  VALIDATE_STRUCTURE
+    also checks the prefix, amount and tagged field layout, and (unlike
+    lndecode, which skips them) rejects `p`, `h` or `n` fields of the wrong
+    length, or a missing `p`.  Neither does any elliptic curve work.
+    VALIDATE_SIGNATURE also checks the signature, as lndecode does.
+    """
+    if level not in (VALIDATE_CHECKSUM, VALIDATE_STRUCTURE, VALIDATE_SIGNATURE):
+        raise ValueError("Unknown validation level {}".format(level))
+
+    if level == VALIDATE_CHECKSUM:
+        hrp, data = bech32_decode(a)
+        if not hrp:
+            raise ValueError("Bad bech32 checksum")
+        return
+
+    hrp, data, sigdecoded = split_invoice(a)
+    offsets = tag_offsets(data)
+    parse_hrp(LnAddr(), hrp)
+
+    # BOLT #11:
+    #
+    # A reader MUST skip over ... a `p`, `h`, or `n` field which does not
+    # have `data_length` 52, 52, or 53 respectively.
+    lengths = {'p': 52, 'h': 52, 'n': 53}
+    for tag, start, end in offsets:
+        if tag in lengths and end - start != lengths[tag]:
+            raise ValueError("'{}' field has data_length {}, not {}".format(
+                tag, end - start, lengths[tag]))
+    if 'p' not in [tag for tag, start, end in offsets]:
+        raise ValueError("No payment hash")
+
+    if level == VALIDATE_SIGNATURE:
+        LazyLnAddr(hrp, data, sigdecoded, offsets).verify()
+
+def addr_to_dict(addr):
+    """ All the fields of a decoded LnAddr, as a JSON-friendly dict.
+    """
+    d = {
+        'currency': addr.currency,
+        'amount': str(addr.amount) if addr.amount_msat is not None else None,
+        'amount_msat': addr.amount_msat,
+        'date': addr.date,
+        'paymenthash': hexlify(addr.paymenthash).decode() if addr.paymenthash else None,
+        'pubkey': hexlify(addr.pubkey.serialize()).decode() if addr.pubkey else None,
+        'routes': [],
+        'fallbacks': [],
+        'unknown_tags': [],
+    }
+    if addr.compact_signature is not None:
+        sig, recid = addr.serialize_signature()
+        d['signature'] = hexlify(sig).decode()
+        d['recovery_id'] = recid
+
+    for k, v in addr.tags:
+        if k == 'd':
+            d['description'] = v
+        elif k == 'h':
+            d['description_hash'] = hexlify(v).decode()
+        elif k == 'x':
+            d['expiry'] = v
+        elif k == 'f':
+            d['fallbacks'].append(v)
+        elif k == 'r':
+            d['routes'].append([{'pubkey': hexlify(pubkey).decode(),
+                                 'short_channel_id': hexlify(channel).decode(),
+                                 'feebase': feebase,
+                                 'feerate': feerate,
+                                 'cltv': cltv}
+                                for pubkey, channel, feebase, feerate, cltv in v])
+
+    for t in addr.unknown_tags:
+        d['unknown_tags'].append({'tag': t.tag, 'bits': t.bits,
+                                  'data': hexlify(t.data).decode()})
+    return d
+
+def addr_from_dict(d):
+    """ An unsigned LnAddr from a dict of fields to encode.
+
+    Takes the same keys as addr_to_dict, except that `description_hashed`
+    is the (unhashed) text for the `h` field, and `fallback` may be given
+    instead of `fallbacks`.
+    """
+    if not d.get('paymenthash'):
+        raise ValueError("No payment hash")
+    addr = LnAddr(unhexlify(d['paymenthash']),
+                  currency=d.get('currency') or 'bc',
+                  date=d.get('date'))
+    if d.get('amount_msat') is not None:
+        addr.amount_msat = int(d['amount_msat'])
+    elif d.get('amount') is not None:
+        addr.amount = d['amount']
+
+    if d.get('description') is not None:
+        addr.tags.append(('d', d['description']))
+    if d.get('description_hashed') is not None:
+        addr.tags.append(('h', d['description_hashed']))
+    if d.get('expiry') is not None:
+        addr.tags.append(('x', int(d['expiry'])))
+    fallbacks = d.get('fallbacks') or []
+    if d.get('fallback'):
+        fallbacks = [d['fallback']] + fallbacks
+    for f in fallbacks:
+        addr.tags.append(('f', f))
+    for route in d.get('routes') or []:
+        addr.tags.append(('r', [(unhexlify(step['pubkey']),
+                                 unhexlify(step['short_channel_id']),
+                                 int(step['feebase']),
+                                 int(step['feerate']),
+                                 int(step['cltv']))
+                                for step in route]))
+    return addr
+
+def map_chunks(func, items, args, executor, chunksize, max_pending):
+    """ Yield func(chunk, *args) results for chunks of items, in order.
+
+    func returns a list with one result per item.  Without an executor
+    chunks are processed here; with one, at most `max_pending` chunks
+    are in flight, so `items` can be arbitrarily long.
+    """
+    items = iter(items)
+    if executor is None:
+        while True:
+            chunk = [a for _, a in zip(range(chunksize), items)]
+            if not chunk:
+                return
+            yield from func(chunk, *args)
+
+    pending = collections.deque()
+    while True:
+        while len(pending) < max_pending:
+            chunk = [a for _, a in zip(range(chunksize), items)]
+            if not chunk:
+                break
+            pending.append(executor.submit(func, chunk, *args))
+        if not pending:
+            return
+        yield from pending.popleft().result()
+
+def lndecode_chunk(invoices, verbose=False, expected_pubkey=None):
+    """ Decode a list of invoices, returning the exception for any that fail.
+    """
+    ret = []
+    for a in invoices:
+        try:
+            ret.append(lndecode(a, verbose, expected_pubkey=expected_pubkey))
+        except Exception as e:
+            ret.append(e)
+    return ret
+
+def lndecode_many(invoices, executor=None, chunksize=1, max_pending=64, verbose=False,
+                  expected_pubkey=None):
+    """ Decode an iterable of invoices, yielding results in input order.
+
+    Each result is either an LnAddr or the exception which decoding that
+    invoice raised.  With an executor (a concurrent.futures thread or
+    process pool), invoices are decoded in chunks of `chunksize`, with at
+    most `max_pending` chunks in flight, so `invoices` can be arbitrarily
+    long.  expected_pubkey is as for lndecode.
+    """
+    if expected_pubkey is not None:
+        # Serialized once, and picklable for process pools.
+        expected_pubkey = pubkey_bytes(expected_pubkey)
+    return map_chunks(lndecode_chunk, invoices, (verbose, expected_pubkey),
+                      executor, chunksize, max_pending)
+
+def lnencode_chunk(addrs, privkey):
+    """ Encode a list of LnAddrs, returning the exception for any that fail.
+    """
+    signer = get_signer(privkey)
+    ret = []
+    for addr in addrs:
+        try:
+            ret.append(signer.encode(addr))
+        except Exception as e:
+            ret.append(e)
+    return ret
+
+def lnencode_many(addrs, privkey, executor=None, chunksize=1, max_pending=64):
+    """ Encode an iterable of LnAddrs, yielding results in input order.
+
+    Each result is either the invoice or the exception which encoding
+    that LnAddr raised.  An executor is used as for lndecode_many: for a
+    process pool, initializer=get_signer, initargs=(privkey,) parses the
+    key as each worker starts.
+    """
+    return map_chunks(lnencode_chunk, addrs, (privkey,), executor, chunksize, max_pending)
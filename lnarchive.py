@@ -0,0 +1,204 @@
+from lnaddr import LnAddr, RouteHop, UnknownTag, ROUTE_HOP
+from lnecdsa import pubkey_cache
+
+import collections
+import mmap
+import struct
+
+# An archive is:
+#
+#   header | variable-length section | records | footer
+#
+# Records are fixed-width, so record i is at records + i * RECORD.size, and
+# each points at its part of the variable-length section.  That holds a run
+# of entries, each a one-byte kind and two-byte length then the payload:
+# lowercase kinds are tags (in their original order), uppercase ones the
+# other fields needed to rebuild an LnAddr.
+MAGIC = b'LNARCHV1'
+HEADER = struct.Struct('<8s')
+# paymenthash, pubkey, date, expiry, amount_msat, var offset, var length.
+RECORD = struct.Struct('<32s33sqqqQI')
+# count, records offset, magic.
+FOOTER = struct.Struct('<QQ8s')
+ENTRY = struct.Struct('<cH')
+UNKNOWN_TAG = struct.Struct('<cH')
+
+# amount_msat of an invoice without an amount.
+NO_AMOUNT = -1
+# Recovery id of a signature which was verified against `n` (so has none).
+NO_RECID = 0xff
+
+ArchiveRecord = collections.namedtuple(
+    'ArchiveRecord', 'paymenthash pubkey date expiry amount_msat offset length')
+
+def encode_var(addr):
+    """ The variable-length section entries for addr.
+    """
+    entries = [(b'C', addr.currency.encode())]
+    for k, v in addr.tags:
+        if k == 'd':
+            v = v.encode('utf-8')
+        elif k == 'x':
+            v = struct.pack('<Q', v)
+        elif k == 'f':
+            v = v.encode('ascii')
+        elif k == 'r':
+            v = b''.join(ROUTE_HOP.pack(*hop) for hop in v)
+        elif k not in ('h', 'n'):
+            raise ValueError("Unknown tag {}".format(k))
+        entries.append((k.encode(), v))
+    for t in addr.unknown_tags:
+        entries.append((b'U', UNKNOWN_TAG.pack(t.tag.encode(), t.bits) + t.data))
+    if addr.compact_signature is not None:
+        sig, recid = addr.serialize_signature()
+        entries.append((b'S', sig + bytes([NO_RECID if recid is None else recid])))
+    return b''.join(ENTRY.pack(kind, len(v)) + v for kind, v in entries)
+
+def decode_var(var):
+    """ Yields (kind, payload) for each entry in var.
+    """
+    pos = 0
+    while pos < len(var):
+        kind, length = ENTRY.unpack_from(var, pos)
+        pos += ENTRY.size
+        yield kind.decode(), var[pos:pos + length]
+        pos += length
+
+
+class ArchiveWriter(object):
+    """ Writes LnAddrs (which must have a pubkey) to an archive file.
+
+    Records are kept in memory until close(), when they are written after
+    the variable-length section.
+    """
+    def __init__(self, path):
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(MAGIC))
+        self.offset = HEADER.size
+        self.records = bytearray()
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, addr):
+        var = encode_var(addr)
+        amount_msat = addr.amount_msat
+        self.records += RECORD.pack(addr.paymenthash or bytes(32),
+                                    addr.pubkey.serialize(),
+                                    addr.date,
+                                    addr.get_expiry(),
+                                    NO_AMOUNT if amount_msat is None else amount_msat,
+                                    self.offset, len(var))
+        self.f.write(var)
+        self.offset += len(var)
+        self.count += 1
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.f.write(self.records)
+        self.f.write(FOOTER.pack(self.count, self.offset, MAGIC))
+        self.f.close()
+
+
+class ArchivedLnAddr(LnAddr):
+    """ LnAddr read from an archive.
+
+    paymenthash, date and amount come from the fixed-width record; the
+    pubkey is only deserialized, and the variable-length fields only
+    parsed, when first accessed.
+    """
+    __slots__ = ('var', 'pubkey_raw')
+
+    def __init__(self, record, var):
+        # Deliberately doesn't call LnAddr.__init__, as LazyLnAddr.
+        self.paymenthash = record.paymenthash
+        self.date = record.date
+        self.amount_msat = None if record.amount_msat == NO_AMOUNT else record.amount_msat
+        self.pubkey_raw = record.pubkey
+        self.var = var
+
+    def __getattr__(self, name):
+        # Only called for attributes which aren't set (yet).
+        if name == 'pubkey':
+            self.pubkey = pubkey_cache.get(self.pubkey_raw)
+        elif name in ('currency', 'tags', 'unknown_tags', 'compact_signature'):
+            self.parse_var()
+        else:
+            raise AttributeError(name)
+        return object.__getattribute__(self, name)
+
+    def parse_var(self):
+        tags, unknown_tags, signature = [], [], None
+        for kind, v in decode_var(self.var):
+            if kind == 'C':
+                self.currency = v.decode()
+            elif kind == 'U':
+                tag, bits = UNKNOWN_TAG.unpack_from(v)
+                unknown_tags.append(UnknownTag(tag.decode(), v[UNKNOWN_TAG.size:], bits))
+            elif kind == 'S':
+                signature = (bytes(v[:64]), None if v[64] == NO_RECID else v[64])
+            elif kind == 'd':
+                tags.append(('d', v.decode('utf-8')))
+            elif kind == 'x':
+                tags.append(('x', struct.unpack('<Q', v)[0]))
+            elif kind == 'f':
+                tags.append(('f', v.decode('ascii')))
+            elif kind == 'r':
+                tags.append(('r', [RouteHop._make(hop) for hop in ROUTE_HOP.iter_unpack(v)]))
+            else:
+                tags.append((kind, v))
+        self.tags, self.unknown_tags, self.compact_signature = tags, unknown_tags, signature
+
+
+class ArchiveReader(object):
+    """ Memory-mapped read access to an archive file.
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if (len(self.map) < HEADER.size + FOOTER.size
+            or HEADER.unpack_from(self.map)[0] != MAGIC):
+            self.map.close()
+            raise ValueError("Not an invoice archive")
+        self.count, self.records_offset, magic = FOOTER.unpack_from(
+            self.map, len(self.map) - FOOTER.size)
+        if (magic != MAGIC
+            or self.records_offset + self.count * RECORD.size + FOOTER.size != len(self.map)):
+            self.map.close()
+            raise ValueError("Truncated invoice archive")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.map.close()
+
+    def record(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("archive index out of range")
+        return ArchiveRecord._make(RECORD.unpack_from(self.map, self.records_offset + i * RECORD.size))
+
+    def records(self):
+        for i in range(self.count):
+            yield self.record(i)
+
+    def addr(self, i):
+        record = self.record(i)
+        return ArchivedLnAddr(record, self.map[record.offset:record.offset + record.length])
+
+    def addrs(self):
+        for i in range(self.count):
+            yield self.addr(i)
@@ -0,0 +1,98 @@
+from lnaddr import lndecode, LnAddr
+
+import collections
+import threading
+import time
+
+
+class FrozenLnAddr(LnAddr):
+    """ Read-only LnAddr, safe to hand out to several callers at once.
+    """
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        raise AttributeError("FrozenLnAddr is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("FrozenLnAddr is read-only")
+
+def freeze(addr):
+    """ Copy an LnAddr, turning its lists into tuples.
+    """
+    frozen = object.__new__(FrozenLnAddr)
+    for k in LnAddr.__slots__:
+        v = getattr(addr, k)
+        if k == 'tags':
+            v = tuple((t, tuple(v) if t == 'r' else v) for t, v in v)
+        elif k == 'unknown_tags':
+            v = tuple(v)
+        object.__setattr__(frozen, k, v)
+    return frozen
+
+
+class DecodeCache(object):
+    """ Bounded LRU cache in front of lndecode.
+
+    Entries are dropped once the invoice itself expires (its `date` plus
+    `x`, or the BOLT #11 default).  Results are FrozenLnAddr objects.
+    """
+    def __init__(self, maxsize=1024, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    # bech32 is case-insensitive (but not mixed-case).
+    @staticmethod
+    def normalize(a):
+        a = a.strip()
+        if a.isupper():
+            a = a.lower()
+        return a
+
+    def decode(self, a):
+        key = self.normalize(a)
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, addr = entry
+                if now < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return addr
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+
+        addr = freeze(lndecode(key))
+        expires = addr.date + addr.get_expiry()
+        if now >= expires:
+            return addr
+
+        with self.lock:
+            self.entries[key] = (expires, addr)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return addr
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
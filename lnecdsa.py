@@ -0,0 +1,465 @@
+import abc
+import collections
+import hashlib
+import hmac
+import threading
+
+
+class Backend(abc.ABC):
+    """ ECDSA over secp256k1, as invoices use it.
+
+    Messages are hashed with SHA256 before signing.  Signatures are 64
+    bytes (r then s, big-endian) with a separate recovery id, and are
+    always low-s.  Public keys are whatever the library uses: the only
+    method callers can rely on is serialize(compressed=True), which
+    gives the 33 (or 65) byte SEC encoding.  Invalid keys and signatures
+    raise ValueError, except in verify(), which just returns False.
+    """
+    name = None
+    # Much slower than the others (benchmarks run it fewer times).
+    slow = False
+
+    @abc.abstractmethod
+    def privkey(self, secret):
+        """ Private key from its 32-byte secret.
+        """
+
+    @abc.abstractmethod
+    def sign_recoverable(self, privkey, msg):
+        """ Returns (signature, recovery id).
+        """
+
+    @abc.abstractmethod
+    def recover(self, msg, sig, recid):
+        """ Public key which made this signature.
+        """
+
+    @abc.abstractmethod
+    def verify(self, pubkey, msg, sig):
+        """ Whether sig is pubkey's signature of msg.
+        """
+
+    @abc.abstractmethod
+    def pubkey(self, data):
+        """ Public key from its (33 or 65 byte) serialization.
+        """
+
+    def serialize(self, pubkey):
+        return pubkey.serialize()
+
+    def signature(self, pubkey, sig, recid):
+        """ The library's signature object for this signature (recid is
+        None for one which was verified rather than recovered).
+        """
+        return (bytes(sig), recid)
+
+    def serialize_signature(self, pubkey, signature):
+        """ Returns (signature, recovery id) from signature().
+        """
+        sig, recid = signature
+        return bytes(sig), recid
+
+
+class SharedContext(object):
+    """ A secp256k1 context, created on first use.
+    """
+    def __init__(self, secp256k1):
+        self.secp256k1 = secp256k1
+        self.base = None
+        self.lock = threading.Lock()
+
+    @property
+    def ctx(self):
+        if self.base is None:
+            with self.lock:
+                if self.base is None:
+                    self.base = self.secp256k1.Base(None, self.secp256k1.ALL_FLAGS)
+        return self.base.ctx
+
+
+class Secp256k1Backend(Backend):
+    """ The `secp256k1` (secp256k1-py) cffi bindings.
+    """
+    name = 'secp256k1'
+
+    def __init__(self):
+        import secp256k1
+        self.secp256k1 = secp256k1
+        # Creating (and destroying) a libsecp256k1 context for every key
+        # is one of the most expensive parts of a decode, so all keys share
+        # this one.  Signing, verification and recovery only read the
+        # context, so it's safe to use from several threads at once.
+        self.context = SharedContext(secp256k1)
+
+    def privkey(self, secret):
+        return self.secp256k1.PrivateKey(bytes(secret), ctx=self.context.ctx)
+
+    def sign_recoverable(self, privkey, msg):
+        sig = privkey.ecdsa_sign_recoverable(bytes(msg))
+        # This doesn't actually serialize, but returns a pair of values :(
+        sig, recid = privkey.ecdsa_recoverable_serialize(sig)
+        return bytes(sig), recid
+
+    def recover(self, msg, sig, recid):
+        pubkey = self.secp256k1.PublicKey(flags=self.secp256k1.ALL_FLAGS, ctx=self.context.ctx)
+        # The bindings raise plain Exceptions.
+        try:
+            sig = pubkey.ecdsa_recoverable_deserialize(bytes(sig), recid)
+            pubkey.public_key = pubkey.ecdsa_recover(bytes(msg), sig)
+        except Exception as e:
+            raise ValueError(str(e)) from e
+        return pubkey
+
+    def verify(self, pubkey, msg, sig):
+        try:
+            sig = pubkey.ecdsa_deserialize_compact(bytes(sig))
+        except Exception:
+            return False
+        return pubkey.ecdsa_verify(bytes(msg), sig)
+
+    def pubkey(self, data):
+        try:
+            return self.secp256k1.PublicKey(bytes(data), raw=True,
+                                            flags=self.secp256k1.ALL_FLAGS,
+                                            ctx=self.context.ctx)
+        except Exception as e:
+            raise ValueError(str(e)) from e
+
+    # secp256k1 has its own cffi signature objects, which older callers of
+    # LnAddr.signature pass to pubkey.ecdsa_verify() and friends.
+    def signature(self, pubkey, sig, recid):
+        if recid is None:
+            return pubkey.ecdsa_deserialize_compact(bytes(sig))
+        return pubkey.ecdsa_recoverable_deserialize(bytes(sig), recid)
+
+    def serialize_signature(self, pubkey, signature):
+        if 'recoverable' in self.secp256k1.ffi.typeof(signature).cname:
+            sig, recid = pubkey.ecdsa_recoverable_serialize(signature)
+            return bytes(sig), recid
+        return bytes(pubkey.ecdsa_serialize_compact(signature)), None
+
+
+class CoincurvePublicKey(object):
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def serialize(self, compressed=True):
+        return self.key.format(compressed)
+
+
+class CoincurveBackend(Backend):
+    """ The `coincurve` cffi bindings.
+    """
+    name = 'coincurve'
+
+    def __init__(self):
+        import coincurve
+        from coincurve.ecdsa import cdata_to_der, deserialize_compact
+        self.coincurve = coincurve
+        self.cdata_to_der = cdata_to_der
+        self.deserialize_compact = deserialize_compact
+
+    def privkey(self, secret):
+        return self.coincurve.PrivateKey(bytes(secret))
+
+    def sign_recoverable(self, privkey, msg):
+        sig = privkey.sign_recoverable(bytes(msg))
+        return sig[:64], sig[64]
+
+    def recover(self, msg, sig, recid):
+        try:
+            key = self.coincurve.PublicKey.from_signature_and_message(
+                bytes(sig) + bytes([recid]), bytes(msg))
+        except Exception as e:
+            raise ValueError(str(e)) from e
+        return CoincurvePublicKey(key)
+
+    def verify(self, pubkey, msg, sig):
+        # coincurve only verifies DER signatures.
+        try:
+            der = self.cdata_to_der(self.deserialize_compact(bytes(sig)))
+        except ValueError:
+            return False
+        return pubkey.key.verify(der, bytes(msg))
+
+    def pubkey(self, data):
+        return CoincurvePublicKey(self.coincurve.PublicKey(bytes(data)))
+
+
+# secp256k1 domain parameters.
+P = 2**256 - 2**32 - 977
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8,
+     1)
+
+# Points are Jacobian (X, Y, Z), for x = X/Z^2 and y = Y/Z^3; None is the
+# point at infinity.
+def point_double(p):
+    if p is None or p[1] == 0:
+        return None
+    x, y, z = p
+    yy = y * y % P
+    s = 4 * x * yy % P
+    m = 3 * x * x % P
+    x3 = (m * m - 2 * s) % P
+    return x3, (m * (s - x3) - 8 * yy * yy) % P, 2 * y * z % P
+
+def point_add(p, q):
+    if p is None:
+        return q
+    if q is None:
+        return p
+    x1, y1, z1 = p
+    x2, y2, z2 = q
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    u2 = x2 * z1z1 % P
+    s1 = y1 * z2 * z2z2 % P
+    s2 = y2 * z1 * z1z1 % P
+    if u1 == u2:
+        return point_double(p) if s1 == s2 else None
+    h = u2 - u1
+    r = s2 - s1
+    hh = h * h % P
+    hhh = h * hh % P
+    v = u1 * hh % P
+    x3 = (r * r - hhh - 2 * v) % P
+    return x3, (r * (v - x3) - s1 * hhh) % P, h * z1 * z2 % P
+
+def point_mul(k, p):
+    result = None
+    for bit in bin(k)[2:]:
+        result = point_double(result)
+        if bit == '1':
+            result = point_add(result, p)
+    return result
+
+def to_affine(p):
+    x, y, z = p
+    zinv = pow(z, -1, P)
+    zinv2 = zinv * zinv % P
+    return x * zinv2 % P, y * zinv2 * zinv % P
+
+def lift_x(x, odd):
+    if x >= P:
+        raise ValueError("Invalid x coordinate")
+    yy = (pow(x, 3, P) + 7) % P
+    y = pow(yy, (P + 1) // 4, P)
+    if y * y % P != yy:
+        raise ValueError("Not a point on the curve")
+    if y & 1 != odd:
+        y = P - y
+    return x, y, 1
+
+def msg_scalar(msg):
+    return int.from_bytes(hashlib.sha256(msg).digest(), 'big') % N
+
+def rfc6979_nonces(secret, e):
+    """ RFC6979 nonces (HMAC-SHA256), as libsecp256k1 generates them.
+    """
+    def mac(k, v):
+        return hmac.new(k, v, 'sha256').digest()
+    seed = secret.to_bytes(32, 'big') + e.to_bytes(32, 'big')
+    k = bytes(32)
+    v = b'\x01' * 32
+    k = mac(k, v + b'\x00' + seed)
+    v = mac(k, v)
+    k = mac(k, v + b'\x01' + seed)
+    v = mac(k, v)
+    while True:
+        v = mac(k, v)
+        nonce = int.from_bytes(v, 'big')
+        if 0 < nonce < N:
+            yield nonce
+        k = mac(k, v + b'\x00')
+        v = mac(k, v)
+
+
+class PythonPublicKey(object):
+    __slots__ = ('point',)
+
+    def __init__(self, point):
+        self.point = point
+
+    def serialize(self, compressed=True):
+        x, y = self.point
+        if compressed:
+            return bytes([2 + (y & 1)]) + x.to_bytes(32, 'big')
+        return b'\x04' + x.to_bytes(32, 'big') + y.to_bytes(32, 'big')
+
+
+class PythonBackend(Backend):
+    """ Pure Python reference: gives the same results as libsecp256k1, but
+    is thousands of times slower, and not constant-time.
+    """
+    name = 'python'
+    slow = True
+
+    def privkey(self, secret):
+        secret = int.from_bytes(secret, 'big')
+        if not 0 < secret < N:
+            raise ValueError("Invalid private key")
+        return secret
+
+    def sign_recoverable(self, privkey, msg):
+        e = msg_scalar(msg)
+        for k in rfc6979_nonces(privkey, e):
+            x, y = to_affine(point_mul(k, G))
+            r = x % N
+            s = pow(k, -1, N) * (e + r * privkey) % N
+            if r == 0 or s == 0:
+                continue
+            recid = (y & 1) | (2 if x >= N else 0)
+            # Low-s, so the signature isn't malleable.
+            if s > N // 2:
+                s = N - s
+                recid ^= 1
+            return r.to_bytes(32, 'big') + s.to_bytes(32, 'big'), recid
+
+    def recover(self, msg, sig, recid):
+        r = int.from_bytes(sig[:32], 'big')
+        s = int.from_bytes(sig[32:64], 'big')
+        if not (0 < r < N and 0 < s < N and 0 <= recid <= 3):
+            raise ValueError("Invalid signature")
+        point = lift_x(r + N if recid & 2 else r, recid & 1)
+        rinv = pow(r, -1, N)
+        q = point_add(point_mul(s * rinv % N, point),
+                      point_mul(-msg_scalar(msg) * rinv % N, G))
+        if q is None:
+            raise ValueError("Invalid signature")
+        return PythonPublicKey(to_affine(q))
+
+    def verify(self, pubkey, msg, sig):
+        r = int.from_bytes(sig[:32], 'big')
+        s = int.from_bytes(sig[32:64], 'big')
+        # libsecp256k1 rejects high-s signatures.
+        if not (0 < r < N and 0 < s <= N // 2):
+            return False
+        sinv = pow(s, -1, N)
+        x, y = pubkey.point
+        p = point_add(point_mul(msg_scalar(msg) * sinv % N, G),
+                      point_mul(r * sinv % N, (x, y, 1)))
+        return p is not None and to_affine(p)[0] % N == r
+
+    def pubkey(self, data):
+        data = bytes(data)
+        if len(data) == 33 and data[0] in (2, 3):
+            x, y, _ = lift_x(int.from_bytes(data[1:], 'big'), data[0] & 1)
+        elif len(data) == 65 and data[0] == 4:
+            x = int.from_bytes(data[1:33], 'big')
+            y = int.from_bytes(data[33:], 'big')
+            if x >= P or y >= P or (y * y - x * x * x - 7) % P:
+                raise ValueError("Not a point on the curve")
+        else:
+            raise ValueError("Invalid public key")
+        return PythonPublicKey((x, y))
+
+
+# All the backends, in order of preference: secp256k1 is the one in
+# requirements.txt, and python is a last resort.  Always taking the first
+# installed (rather than timing them) keeps the type of LnAddr.pubkey the
+# same from run to run: secp256k1.PublicKey whenever secp256k1 is installed.
+BACKENDS = collections.OrderedDict(
+    (cls.name, cls) for cls in (Secp256k1Backend, CoincurveBackend, PythonBackend))
+
+def available_backends():
+    """ Backends whose library is installed, by name.
+    """
+    backends = collections.OrderedDict()
+    for name, cls in BACKENDS.items():
+        try:
+            backends[name] = cls()
+        except ImportError:
+            pass
+    return backends
+
+def preferred_backend():
+    """ The first installed backend, in BACKENDS order.
+    """
+    for cls in BACKENDS.values():
+        try:
+            return cls()
+        except ImportError:
+            pass
+
+backend = None
+backend_lock = threading.Lock()
+
+def get_backend():
+    """ The backend in use: the preferred one installed, chosen on first use.
+    """
+    global backend
+    if backend is None:
+        with backend_lock:
+            if backend is None:
+                backend = preferred_backend()
+    return backend
+
+def set_backend(name):
+    """ Use the named backend from now on, returning it.
+
+    Otherwise get_backend() takes the first installed of secp256k1,
+    coincurve and python, in that order.  Keys already created belong to
+    the old backend, so this is meant for start-up, or benchmarks.
+    """
+    global backend
+    backend = BACKENDS[name]()
+    return backend
+
+
+class PubkeyCache(object):
+    """ Bounded LRU cache of deserialized public keys.
+
+    Invoices mostly come from a few nodes, so deserializing (and, for
+    the cffi backends, allocating) each of their keys once saves time on
+    every decode.  Keys are only shared while the backend stays the same.
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, data):
+        """ Public key from its serialization, raising ValueError if invalid.
+        """
+        data = bytes(data)
+        backend = get_backend()
+        with self.lock:
+            entry = self.entries.get(data)
+            if entry is not None and entry[0] is backend:
+                self.entries.move_to_end(data)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        pubkey = backend.pubkey(data)
+        with self.lock:
+            self.entries[data] = (backend, pubkey)
+            self.entries.move_to_end(data)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return pubkey
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+pubkey_cache = PubkeyCache()
@@ -0,0 +1,109 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+
+class ExpiryTracker(object):
+    """ Invoices ordered by when they expire.
+
+    Each LnAddr's expiry (its `date` plus `x`, or the BOLT #11 default) is
+    computed once, when it is added, and kept in a heap: finding expired
+    invoices costs O(log n) per expired invoice, however many are live.
+    Invoices are keyed by payment hash unless another key is given;
+    adding one with an existing key replaces it.  Removal is lazy: the
+    heap entry is skipped when it reaches the top, and the heap rebuilt
+    once more than half of it is stale.  Several expirations() consumers
+    can share a tracker: each expired invoice goes to one of them.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        # key -> heap entry, for entries which are still live.
+        self.live = {}
+        self.counter = itertools.count()
+        # An Event per expirations() consumer, set by add().
+        self.waiters = set()
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, key):
+        return key in self.live
+
+    def add(self, addr, key=None):
+        """ Track addr, returning when it expires.
+        """
+        if key is None:
+            key = addr.paymenthash
+        expires = addr.date + addr.get_expiry()
+        # The counter breaks ties, so addrs themselves are never compared.
+        entry = [expires, next(self.counter), key, addr]
+        if self.live.pop(key, None) is not None:
+            self.compact_if_stale()
+        self.live[key] = entry
+        heapq.heappush(self.heap, entry)
+        for wakeup in self.waiters:
+            wakeup.set()
+        return expires
+
+    def remove(self, key):
+        """ Stop tracking the invoice with this key, returning it.
+        """
+        entry = self.live.pop(key)
+        self.compact_if_stale()
+        return entry[3]
+
+    def expiry(self, key):
+        return self.live[key][0]
+
+    def compact_if_stale(self):
+        if len(self.heap) > 2 * len(self.live) + 1:
+            self.heap = list(self.live.values())
+            heapq.heapify(self.heap)
+
+    # Drop removed (or replaced) entries from the top of the heap.
+    def prune(self):
+        heap = self.heap
+        while heap and self.live.get(heap[0][2]) is not heap[0]:
+            heapq.heappop(heap)
+
+    def next_expiry(self):
+        """ When the next invoice expires, or None if none are tracked.
+        """
+        self.prune()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_expired(self, now=None):
+        """ Stop tracking and return invoices which expired by now.
+        """
+        if now is None:
+            now = self.clock()
+        expired = []
+        while True:
+            self.prune()
+            if not self.heap or self.heap[0][0] > now:
+                return expired
+            expires, _, key, addr = heapq.heappop(self.heap)
+            del self.live[key]
+            expired.append(addr)
+
+    async def expirations(self):
+        """ Yield each invoice as it expires, forever.
+        """
+        wakeup = asyncio.Event()
+        self.waiters.add(wakeup)
+        try:
+            while True:
+                for addr in self.pop_expired():
+                    yield addr
+                # Anything added from here on sets wakeup again.
+                wakeup.clear()
+                expires = self.next_expiry()
+                timeout = None if expires is None else max(0, expires - self.clock())
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.waiters.discard(wakeup)
@@ -0,0 +1,160 @@
+from lnaddr import lndecode
+
+import bisect
+import math
+import operator
+
+
+class InvoiceIndex(object):
+    """ Decoded invoices, by payment hash, payee pubkey and date.
+
+    Adding an invoice (an LnAddr, or a string to decode) whose payment
+    hash is already present replaces the old one; adding the very same
+    LnAddr again changes nothing.  Invoices without a pubkey (made
+    locally, and not yet encoded) are left out of the payee index.
+    Invoices added in date order are appended to the date index; others
+    go into a small sorted overflow, merged in once it exceeds 16 times
+    the square root of the index size (1024 entries for indexes under
+    4096), which balances inserting into the overflow against merging
+    it.  add_many() sorts a whole batch at once.  Removal only drops the
+    invoice from the hash maps: the date index skips removed entries
+    until more than half of it is stale, then it is compacted.
+    """
+    def __init__(self, items=()):
+        self.by_hash = {}
+        self.by_payee = {}
+        # Parallel lists, sorted by date.
+        self.dates = []
+        self.addrs = []
+        self.late_dates = []
+        self.late_addrs = []
+        # ids of removed invoices still in the date index (which keeps
+        # them alive, so the ids aren't reused).
+        self.stale = set()
+        self.add_many(items)
+
+    def __len__(self):
+        return len(self.by_hash)
+
+    def __contains__(self, paymenthash):
+        return paymenthash in self.by_hash
+
+    def __iter__(self):
+        return iter(self.by_hash.values())
+
+    @staticmethod
+    def payee_key(pubkey):
+        if isinstance(pubkey, bytes):
+            return pubkey
+        return pubkey.serialize()
+
+    def get(self, paymenthash, default=None):
+        return self.by_hash.get(paymenthash, default)
+
+    def for_payee(self, pubkey):
+        """ Invoices for this payee (a PublicKey, or its serialization).
+        """
+        return list(self.by_payee.get(self.payee_key(pubkey), {}).values())
+
+    def between(self, start=None, end=None):
+        """ Invoices with start <= date < end, in date order.
+        """
+        lo, hi = self.bounds(self.dates, start, end)
+        addrs = self.addrs[lo:hi]
+        # Splice in the (few) overflow entries in range.
+        late_lo, late_hi = self.bounds(self.late_dates, start, end)
+        for n, i in enumerate(range(late_lo, late_hi)):
+            pos = bisect.bisect_right(self.dates, self.late_dates[i], lo, hi) - lo + n
+            addrs.insert(pos, self.late_addrs[i])
+        if not self.stale:
+            return addrs
+        return [addr for addr in addrs if self.is_live(addr)]
+
+    @staticmethod
+    def bounds(dates, start, end):
+        lo = 0 if start is None else bisect.bisect_left(dates, start)
+        hi = len(dates) if end is None else bisect.bisect_left(dates, end)
+        return lo, hi
+
+    def is_live(self, addr):
+        return self.by_hash.get(addr.paymenthash) is addr
+
+    # Adds addr to the hash maps, replacing any invoice with its hash.
+    # Returns False if addr already has an entry in the date index.
+    def insert(self, addr):
+        old = self.by_hash.get(addr.paymenthash)
+        if old is addr:
+            return False
+        if old is not None:
+            self.remove(addr.paymenthash)
+        self.by_hash[addr.paymenthash] = addr
+        # LnAddrs made locally have no pubkey until they're encoded.
+        if addr.pubkey is not None:
+            self.by_payee.setdefault(self.payee_key(addr.pubkey), {})[addr.paymenthash] = addr
+        if id(addr) in self.stale:
+            # Removed earlier: its old date index entry is live again.
+            self.stale.remove(id(addr))
+            return False
+        return True
+
+    def add(self, item):
+        addr = lndecode(item) if isinstance(item, str) else item
+        if not self.insert(addr):
+            return addr
+        if self.dates and addr.date < self.dates[-1]:
+            i = bisect.bisect_right(self.late_dates, addr.date)
+            self.late_dates.insert(i, addr.date)
+            self.late_addrs.insert(i, addr)
+            if len(self.late_dates) > 16 * max(64, math.isqrt(len(self.dates))):
+                self.compact()
+        else:
+            self.dates.append(addr.date)
+            self.addrs.append(addr)
+        return addr
+
+    def add_many(self, items):
+        addrs = [lndecode(item) if isinstance(item, str) else item for item in items]
+        added = {id(addr): addr for addr in addrs if self.insert(addr)}
+        # Later items can replace earlier ones, which then have no date
+        # index entry to be stale.
+        for key, addr in list(added.items()):
+            if not self.is_live(addr):
+                del added[key]
+                self.stale.discard(key)
+        if added:
+            self.dates += [addr.date for addr in added.values()]
+            self.addrs += added.values()
+            self.compact()
+        return addrs
+
+    def remove(self, paymenthash):
+        """ Remove and return the invoice with this payment hash.
+        """
+        addr = self.by_hash.pop(paymenthash)
+        if addr.pubkey is not None:
+            key = self.payee_key(addr.pubkey)
+            payee = self.by_payee[key]
+            del payee[paymenthash]
+            if not payee:
+                del self.by_payee[key]
+
+        self.stale.add(id(addr))
+        if len(self.stale) > (len(self.dates) + len(self.late_dates)) // 2:
+            self.compact()
+        return addr
+
+    def remove_many(self, paymenthashes):
+        return [self.remove(h) for h in paymenthashes]
+
+    def compact(self):
+        """ Merge the overflow, drop removed invoices from the date index
+        and sort it.
+        """
+        self.addrs += self.late_addrs
+        self.late_dates, self.late_addrs = [], []
+        if self.stale:
+            self.addrs = [addr for addr in self.addrs if self.is_live(addr)]
+            self.stale = set()
+        # Nearly sorted already, which sort() is fast at.
+        self.addrs.sort(key=operator.attrgetter('date'))
+        self.dates = [addr.date for addr in self.addrs]
@@ -0,0 +1,246 @@
+#! /usr/bin/env python3
+from concurrent.futures import ProcessPoolExecutor
+from lnaddr import lndecode, addr_to_dict, addr_from_dict, get_signer
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import time
+
+
+def handle_request(req, privkey=None):
+    """ Answer one request object, returning the reply object.
+
+    {"id": ..., "method": "decode", "invoice": "lnbc..."} replies with
+    {"id": ..., "result": <addr_to_dict>}, and {"id": ..., "method": "encode",
+    "addr": {<addr_from_dict fields>}} with {"id": ..., "result":
+    {"invoice": "lnbc..."}}.  Failures reply {"id": ..., "error": "..."}.
+    """
+    if not isinstance(req, dict):
+        return {'id': None, 'error': 'Request must be a JSON object'}
+    reply = {'id': req.get('id')}
+    try:
+        method = req.get('method')
+        if method == 'decode':
+            reply['result'] = addr_to_dict(lndecode(req['invoice']))
+        elif method == 'encode':
+            if privkey is None:
+                raise ValueError("No private key to encode with")
+            invoice = get_signer(privkey).encode(addr_from_dict(req['addr']))
+            reply['result'] = {'invoice': invoice}
+        else:
+            raise ValueError("Unknown method {}".format(method))
+    except KeyError as e:
+        reply['error'] = "Missing field {}".format(e)
+    except Exception as e:
+        reply['error'] = str(e)
+    return reply
+
+def handle_batch(reqs, privkey=None):
+    return [handle_request(req, privkey) for req in reqs]
+
+# Nearest-rank percentile of a sorted list.
+def percentile(values, p):
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def latency_stats(latencies):
+    """ p50/p90/p99 of latencies in seconds, as milliseconds.
+    """
+    latencies = sorted(latencies)
+    return {name: None if v is None else v * 1000
+            for name, v in (('p50', percentile(latencies, 50)),
+                            ('p90', percentile(latencies, 90)),
+                            ('p99', percentile(latencies, 99)))}
+
+
+class InvoiceServer(object):
+    """ Line-delimited JSON decode/encode service.
+
+    Requests from all connections go through one bounded queue (readers
+    stop reading once it is full), and are handed to `executor` in batches
+    of up to `batch_size`, waiting `batch_delay` seconds for a batch to
+    fill.  At most `max_batches` batches are in flight.  Each connection
+    gets its replies in request order.  A {"method": "stats"} request is
+    answered directly, with queue depth and latency percentiles.
+    """
+    def __init__(self, privkey=None, executor=None, batch_size=64, batch_delay=0.002,
+                 max_queue=1024, max_batches=None, max_pending=256):
+        self.privkey = privkey
+        self.executor = executor
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.max_queue = max_queue
+        self.max_batches = max_batches or (os.cpu_count() or 1) * 2
+        self.max_pending = max_pending
+        self.requests = 0
+        self.batches = 0
+        self.inflight = 0
+        self.latencies = collections.deque(maxlen=10000)
+        self.queue = None
+        self.server = None
+        self.batcher_task = None
+        self.clients = set()
+
+    async def start(self, host=None, port=None, path=None):
+        """ Listen on the Unix socket `path`, or on TCP `host`:`port`.
+        """
+        self.queue = asyncio.Queue(self.max_queue)
+        self.slots = asyncio.Semaphore(self.max_batches)
+        self.batcher_task = asyncio.ensure_future(self.batcher())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle_client, path)
+        else:
+            self.server = await asyncio.start_server(self.handle_client, host, port)
+        return self.server
+
+    async def close(self):
+        self.server.close()
+        for task in self.clients:
+            task.cancel()
+        await asyncio.gather(*self.clients, return_exceptions=True)
+        await self.server.wait_closed()
+        self.batcher_task.cancel()
+
+    def stats(self):
+        return {'queue_depth': self.queue.qsize(),
+                'max_queue': self.max_queue,
+                'inflight_batches': self.inflight,
+                'requests': self.requests,
+                'batches': self.batches,
+                'latency_ms': latency_stats(self.latencies)}
+
+    async def handle_client(self, reader, writer):
+        task = asyncio.current_task()
+        self.clients.add(task)
+        replies = asyncio.Queue(self.max_pending)
+        sender = asyncio.ensure_future(self.send_replies(replies, writer))
+        try:
+            await self.read_requests(reader, replies)
+            await replies.put(None)
+            await sender
+        finally:
+            sender.cancel()
+            writer.close()
+            self.clients.discard(task)
+
+    async def read_requests(self, reader, replies):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                line = await reader.readline()
+            except (ValueError, ConnectionError):
+                return
+            if not line:
+                return
+            if not line.strip():
+                continue
+
+            fut = loop.create_future()
+            try:
+                req = json.loads(line)
+            except ValueError as e:
+                fut.set_result({'id': None, 'error': 'Bad JSON: {}'.format(e)})
+            else:
+                if isinstance(req, dict) and req.get('method') == 'stats':
+                    fut.set_result({'id': req.get('id'), 'result': self.stats()})
+                else:
+                    self.requests += 1
+                    await self.queue.put((req, fut, time.perf_counter()))
+            await replies.put(fut)
+
+    async def send_replies(self, replies, writer):
+        connected = True
+        while True:
+            fut = await replies.get()
+            if fut is None:
+                return
+            reply = await fut
+            if not connected:
+                continue
+            try:
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+            except ConnectionError:
+                connected = False
+
+    async def batcher(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.batch_delay and self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.batch_delay)
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self.slots.acquire()
+            self.batches += 1
+            self.inflight += 1
+            asyncio.ensure_future(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            replies = await loop.run_in_executor(self.executor, handle_batch,
+                                                 [req for req, fut, start in batch],
+                                                 self.privkey)
+        except Exception as e:
+            replies = [{'id': req.get('id') if isinstance(req, dict) else None,
+                        'error': str(e)}
+                       for req, fut, start in batch]
+        finally:
+            self.inflight -= 1
+            self.slots.release()
+
+        now = time.perf_counter()
+        for (req, fut, start), reply in zip(batch, replies):
+            self.latencies.append(now - start)
+            if not fut.done():
+                fut.set_result(reply)
+
+
+async def serve(options):
+    executor = ProcessPoolExecutor(options.workers) if options.workers else None
+    server = InvoiceServer(options.privkey, executor,
+                           batch_size=options.batch_size,
+                           batch_delay=options.batch_delay / 1000,
+                           max_queue=options.max_queue)
+    if options.unix:
+        await server.start(path=options.unix)
+    else:
+        await server.start(options.host, options.port)
+    try:
+        await server.server.serve_forever()
+    finally:
+        if executor:
+            executor.shutdown()
+
+
+parser = argparse.ArgumentParser(description='Serve invoice encoding and decoding as line-delimited JSON')
+parser.add_argument('--unix', metavar='PATH',
+                    help='Listen on Unix socket PATH')
+parser.add_argument('--host', default='127.0.0.1',
+                    help='Address to listen on')
+parser.add_argument('--port', type=int,
+                    help='TCP port to listen on')
+parser.add_argument('--privkey',
+                    help='Private key (in hex) to sign encode requests with')
+parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                    help='Worker processes (0 to use threads)')
+parser.add_argument('--batch-size', type=int, default=64,
+                    help='Most requests per worker task')
+parser.add_argument('--batch-delay', type=float, default=2,
+                    help='Milliseconds to wait for a batch to fill')
+parser.add_argument('--max-queue', type=int, default=1024,
+                    help='Requests to queue before applying backpressure')
+
+if __name__ == "__main__":
+    options = parser.parse_args()
+    if not options.unix and options.port is None:
+        parser.error("need --unix or --port")
+    try:
+        asyncio.run(serve(options))
+    except KeyboardInterrupt:
+        pass
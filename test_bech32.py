@@ -0,0 +1,70 @@
+#! /usr/bin/python3
+
+from bech32 import bech32_encode, bech32_decode, bech32_decode_ref, bech32_polymod, bech32_polymod_ref, bech32_verify_many, CHARSET
+
+import bech32
+import pytest
+import random
+
+
+def test_polymod_matches_reference():
+    r = random.Random(1)
+    for n in range(0, 300, 7):
+        values = [r.randrange(32) for _ in range(n)]
+        assert bech32_polymod(values) == bech32_polymod_ref(values)
+
+
+def test_decode_matches_reference():
+    r = random.Random(2)
+    tests = ['', '1', 'a12uel5l', 'A12UEL5L', 'a12UEL5L', 'ab1\x7fqqqqqq',
+             'lnbc1éqqqqqq', 'an83characterlonghumanreadablepartthatcontainsthenumber1andtheexcludedcharactersbio1tt5tgs',
+             'pzry9x0s0muk', '1pzry9x0s0muk', 'x1b4n0q5v', 'li1dgmt3', 'de1lg7wt\xff']
+    for _ in range(100):
+        hrp = 'ln' + ''.join(r.choice('bctn0123456789munp') for _ in range(r.randrange(1, 8)))
+        data = [r.randrange(32) for _ in range(r.randrange(0, 400))]
+        s = bech32_encode(hrp, data)
+        tests.append(s)
+        tests.append(s.upper())
+        # Corrupt one character.
+        i = r.randrange(len(hrp) + 1, len(s))
+        tests.append(s[:i] + CHARSET[(CHARSET.find(s[i]) + 1) % 32] + s[i+1:])
+        tests.append(s[:i] + 'b' + s[i+1:])
+
+    for t in tests:
+        assert bech32_decode(t) == bech32_decode_ref(t)
+
+
+def verify_many_tests():
+    r = random.Random(3)
+    tests = ['', 'a12uel5l', 'A12UEL5L', 'a12UEL5L', 'lnbc1éqqqqqq', 'x1b4n0q5v']
+    for _ in range(300):
+        hrp = r.choice(['lnbc', 'lntb', 'lnbc2500u', 'lnbc20m'])
+        # Mostly similar lengths, so some batches are big enough for NumPy.
+        data = [r.randrange(32) for _ in range(r.choice([r.randrange(0, 600), 300, 301]))]
+        s = bech32_encode(hrp, data)
+        i = r.randrange(len(hrp) + 1, len(s))
+        tests.append(r.choice([s, s.upper(), s[:i] + CHARSET[(CHARSET.find(s[i]) + 1) % 32] + s[i+1:]]))
+    return tests
+
+def test_verify_many():
+    pytest.importorskip('numpy')
+    tests = verify_many_tests()
+    expected = [bech32_decode(t) for t in tests]
+    for min_batch in (1, 64, len(tests) + 1):
+        mask, splits = bech32_verify_many(tests, min_batch)
+        assert splits == expected
+        assert mask == [hrp is not None for hrp, data in expected]
+        assert all(type(ok) is bool for ok in mask)
+
+def test_verify_many_without_numpy(monkeypatch):
+    monkeypatch.setattr(bech32, 'numpy', None)
+    tests = verify_many_tests()
+    mask, splits = bech32_verify_many(tests)
+    assert splits == [bech32_decode(t) for t in tests]
+    assert mask == [hrp is not None for hrp, data in splits]
+
+
+if __name__ == '__main__':
+    test_polymod_matches_reference()
+    test_decode_matches_reference()
+    test_verify_many()
@@ -0,0 +1,136 @@
+#! /usr/bin/python3
+
+from binascii import hexlify, unhexlify
+from lnaddr import LnAddr, lnencode
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RHASH=unhexlify('0001020304050607080900010203040506070809000102030405060708090102')
+PRIVKEY=b'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+PUBKEY=b'03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad'
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(*args, input=None):
+    proc = subprocess.run([sys.executable, os.path.join(HERE, 'lightning-address.py')] + list(args),
+                          input=None if input is None else input.encode(),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=HERE)
+    return proc.returncode, proc.stdout.decode(), proc.stderr.decode()
+
+
+def test_encode_interleaved():
+    # As examples.sh does it: options before, between and after positionals.
+    code, out, err = run('encode', '--timestamp=1496314658', '--no-amount', '0',
+                         '--description=Please consider supporting this project',
+                         hexlify(RHASH).decode(), PRIVKEY.decode())
+    assert code == 0, err
+    assert out == lnencode(LnAddr(RHASH, date=1496314658,
+                                  tags=[('d', 'Please consider supporting this project')]),
+                           PRIVKEY) + '\n'
+
+    code, out, err = run('encode', '--timestamp=1496314658', '--description=x', '250000000',
+                         '--expires=60', hexlify(RHASH).decode(), PRIVKEY.decode())
+    assert code == 0, err
+    assert out == lnencode(LnAddr(RHASH, amount_msat=250000000, date=1496314658,
+                                  tags=[('d', 'x'), ('x', 60)]), PRIVKEY) + '\n'
+
+    code, out, err = run('encode', '--description=x', hexlify(RHASH).decode(), PRIVKEY.decode())
+    assert code == 2 and 'required' in err
+    code, out, err = run('encode', '0', hexlify(RHASH).decode(), PRIVKEY.decode(), 'extra')
+    assert code == 2 and 'unrecognized arguments: extra' in err
+
+
+def test_encode_batch():
+    rhash = hexlify(RHASH).decode()
+    records = [json.dumps({'paymenthash': rhash, 'amount_msat': 1000, 'date': 1496314658,
+                           'description': '0'}),
+               'not json',
+               json.dumps({'amount_msat': 5}),
+               json.dumps({'paymenthash': rhash}),
+               json.dumps({'paymenthash': rhash, 'date': 1496314658, 'description': '4'})]
+    expected = [lnencode(LnAddr(RHASH, amount_msat=1000, date=1496314658, tags=[('d', '0')]), PRIVKEY),
+                lnencode(LnAddr(RHASH, date=1496314658, tags=[('d', '4')]), PRIVKEY)]
+
+    with tempfile.TemporaryDirectory() as d:
+        jsonl = os.path.join(d, 'records.jsonl')
+        with open(jsonl, 'w') as f:
+            f.write('\n'.join(records) + '\n')
+        for workers in ('1', '2'):
+            code, out, err = run('encode-batch', '--workers', workers, '--chunksize', '1',
+                                 jsonl, PRIVKEY.decode())
+            assert code == 0, err
+            lines = [json.loads(line) for line in out.splitlines()]
+            assert [line['record'] for line in lines] == list(range(5))
+            assert [line.get('invoice') for line in lines] == [expected[0], None, None, None, expected[1]]
+            assert lines[2]['error'] == 'No payment hash'
+            assert lines[3] == {'record': 3, 'paymenthash': rhash,
+                                'error': "Must include either 'd' or 'h'"}
+            assert 'error' in lines[1]
+
+        csv_text = ('paymenthash,amount_msat,date,description\n'
+                    '{0},1000,1496314658,0\n'
+                    '{0},x,1496314658,1\n'.format(rhash))
+        csvfile = os.path.join(d, 'records.csv')
+        with open(csvfile, 'w') as f:
+            f.write(csv_text)
+        code, out, err = run('encode-batch', '--workers', '1', csvfile, PRIVKEY.decode())
+        assert code == 0, err
+        first, bad = [json.loads(line) for line in out.splitlines()]
+        assert first['invoice'] == expected[0]
+        assert bad['record'] == 1 and 'error' in bad
+
+        # From stdin, which has no name to guess the format from.
+        code, out, err = run('encode-batch', '--format', 'csv', '--workers', '1', '-', PRIVKEY.decode(),
+                             input=csv_text)
+        assert json.loads(out.splitlines()[0])['invoice'] == expected[0]
+
+
+def test_decode_stream():
+    other = '029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'
+    invoices = [lnencode(LnAddr(RHASH, amount_msat=i + 1, date=1496314658, tags=[('d', str(i))]), PRIVKEY)
+                for i in range(5)]
+    # Checksum failure.
+    invoices.insert(1, invoices[0][:-1] + ('q' if invoices[0][-1] != 'q' else 'p'))
+    invoices.insert(3, 'not an invoice')
+    # Names another payee in `n`.
+    invoices.append(lnencode(LnAddr(RHASH, date=1496314658,
+                                    tags=[('d', 'n'), ('n', unhexlify(other))]), PRIVKEY))
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'invoices')
+        with open(path, 'w') as f:
+            f.write('\n'.join(invoices[:4]) + '\n\n' + '\n'.join(invoices[4:]) + '\n')
+        for workers in ('1', '2'):
+            code, out, err = run('decode', '--stream', path, '--workers', workers, '--chunksize', '2')
+            assert code == 0, err
+            lines = [json.loads(line) for line in out.splitlines()]
+            assert [line['invoice'] for line in lines] == invoices
+            assert ['error' in line for line in lines] == [False, True, False, True, False, False, False, True]
+            assert [line['description'] for line in lines if 'error' not in line] == ['0', '1', '2', '3', '4']
+            assert lines[-1]['error'] == 'Invalid signature'
+
+            # With the payee known, the one naming another is rejected for it.
+            code, out, err = run('decode', '--stream', '-', '--workers', workers,
+                                 '--pubkey', PUBKEY.decode(), input='\n'.join(invoices))
+            assert code == 0, err
+            lines = [json.loads(line) for line in out.splitlines()]
+            assert [line['invoice'] for line in lines] == invoices
+            assert ['error' in line for line in lines] == [False, True, False, True, False, False, False, True]
+            assert all(line['pubkey'] == PUBKEY.decode() for line in lines if 'error' not in line)
+            assert lines[-1]['error'] == 'Payee is not the expected public key'
+
+            code, out, err = run('decode', '--stream', '-', '--workers', workers, '--pubkey', other,
+                                 input='\n'.join(invoices))
+            assert code == 0, err
+            assert all('error' in json.loads(line) for line in out.splitlines())
+
+
+if __name__ == '__main__':
+    test_encode_interleaved()
+    test_encode_batch()
+    test_decode_stream()
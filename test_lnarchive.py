@@ -0,0 +1,89 @@
+#! /usr/bin/python3
+
+from binascii import unhexlify
+from decimal import Decimal
+from lnaddr import LnAddr, UnknownTag, lnencode, lndecode, addr_to_dict
+from lnarchive import ArchiveReader, ArchiveWriter, NO_AMOUNT
+
+import os
+import pickle
+import pytest
+import tempfile
+
+RHASH=unhexlify('0001020304050607080900010203040506070809000102030405060708090102')
+PRIVKEY=b'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+PUBKEY=b'03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad'
+
+
+def sample_addrs():
+    route = [(unhexlify('029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'), unhexlify('0102030405060708'), 1, 20, 3),
+             (unhexlify('039e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'), unhexlify('030405060708090a'), 2, 30, 4)]
+    invoices = [
+        lnencode(LnAddr(RHASH, date=1496314658, tags=[('d', 'Please consider supporting this project')]), PRIVKEY),
+        lnencode(LnAddr(RHASH, amount=Decimal('0.0025'), date=1496314658,
+                        tags=[('d', 'ナンセンス 1杯'), ('x', 60)]), PRIVKEY),
+        lnencode(LnAddr(RHASH, amount=Decimal('0.02'), currency='tb', date=1496314658,
+                        tags=[('h', 'list of things'), ('f', 'mk2QpYatsKicvFVuTAQLBryyccRXMUaGHP')]), PRIVKEY),
+        lnencode(LnAddr(RHASH, amount=Decimal('0.02'), date=1496314658,
+                        tags=[('f', '1RustyRX2oai4EYYDpQGWvEL62BBGqN9T'), ('r', route),
+                              ('h', 'list of things'), ('n', unhexlify(PUBKEY))]), PRIVKEY),
+    ]
+    addrs = [lndecode(a) for a in invoices]
+    addrs[0].unknown_tags.append(UnknownTag('v', b'\x08\xbe', 15))
+    return addrs
+
+
+def test_archive_roundtrip():
+    addrs = sample_addrs()
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'invoices.lnar')
+        with ArchiveWriter(path) as w:
+            for a in addrs:
+                w.add(a)
+
+        with ArchiveReader(path) as r:
+            assert len(r) == len(addrs)
+            for i, a in enumerate(addrs):
+                record = r.record(i)
+                assert record.paymenthash == a.paymenthash
+                assert record.pubkey == a.pubkey.serialize()
+                assert record.date == a.date
+                assert record.expiry == a.get_expiry()
+                assert record.amount_msat == (NO_AMOUNT if a.amount_msat is None else a.amount_msat)
+            assert r.record(-1) == r.record(len(addrs) - 1)
+            with pytest.raises(IndexError):
+                r.record(len(addrs))
+
+            for a, b in zip(addrs, r.addrs()):
+                # Only the fixed-width fields are decoded up front.
+                with pytest.raises(AttributeError):
+                    object.__getattribute__(b, 'tags')
+                assert addr_to_dict(b) == addr_to_dict(a)
+                assert b.tags == a.tags
+                assert b.unknown_tags == a.unknown_tags
+
+            b = pickle.loads(pickle.dumps(r.addr(0)))
+        assert addr_to_dict(b) == addr_to_dict(addrs[0])
+
+
+def test_archive_bad_file():
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'invoices.lnar')
+        with open(path, 'wb') as f:
+            f.write(b'not an archive' * 10)
+        with pytest.raises(ValueError):
+            ArchiveReader(path)
+
+        with ArchiveWriter(path) as w:
+            w.add(sample_addrs()[0])
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data[:-1])
+        with pytest.raises(ValueError):
+            ArchiveReader(path)
+
+
+if __name__ == '__main__':
+    test_archive_roundtrip()
+    test_archive_bad_file()
@@ -0,0 +1,63 @@
+#! /usr/bin/python3
+
+from binascii import unhexlify
+from lnaddr import LnAddr, lnencode
+from lncache import DecodeCache
+
+import pytest
+
+RHASH=unhexlify('0001020304050607080900010203040506070809000102030405060708090102')
+PRIVKEY=b'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+
+
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_hits_and_evictions():
+    clock = Clock(1000)
+    cache = DecodeCache(maxsize=2, clock=clock)
+    invoices = [lnencode(LnAddr(RHASH, amount=i + 1, date=1000, tags=[('d', str(i))]), PRIVKEY)
+                for i in range(3)]
+
+    a = cache.decode(invoices[0])
+    assert cache.decode(invoices[0].upper()) is a
+    cache.decode(invoices[1])
+    cache.decode(invoices[0])
+    # Evicts invoices[1], the least recently used.
+    cache.decode(invoices[2])
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 3, 'evictions': 1, 'expirations': 0}
+    assert cache.decode(invoices[0]) is a
+    assert cache.decode(invoices[1]) is not None
+    assert cache.stats()['misses'] == 4
+
+    # Results can't be modified.
+    with pytest.raises(AttributeError):
+        a.amount = 1
+    with pytest.raises(AttributeError):
+        a.tags.append(('d', 'foo'))
+
+
+def test_cache_expiry():
+    clock = Clock(1000)
+    cache = DecodeCache(clock=clock)
+    short = lnencode(LnAddr(RHASH, date=1000, tags=[('d', ''), ('x', 60)]), PRIVKEY)
+    default = lnencode(LnAddr(RHASH, date=1000, tags=[('d', '')]), PRIVKEY)
+
+    a = cache.decode(short)
+    b = cache.decode(default)
+    clock.now = 1059
+    assert cache.decode(short) is a
+    clock.now = 1060
+    assert cache.decode(short) is not a
+    assert cache.decode(default) is b
+    assert cache.stats()['expirations'] == 1
+    # Already expired invoices are not cached at all.
+    assert len(cache) == 1
+    clock.now = 1000 + 3600
+    cache.decode(default)
+    assert len(cache) == 0
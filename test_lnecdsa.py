@@ -0,0 +1,140 @@
+#! /usr/bin/python3
+
+from binascii import unhexlify
+from lnaddr import LnAddr, lnencode, lndecode, addr_to_dict
+
+import lnaddr
+import lnecdsa
+import pytest
+import random
+
+RHASH=unhexlify('0001020304050607080900010203040506070809000102030405060708090102')
+PRIVKEY=b'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+PUBKEY=b'03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad'
+
+# The BOLT #11 "1 cup coffee" example, signed by libsecp256k1.
+INVOICE='lnbc2500u1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdq5xysxxatsyp3k7enxv4jsxqzpuaztrnwngzn3kdzw5hydlzf03qdgm2hdq27cqv3agm2awhz5se903vruatfhq77w3ls4evs3ch9zw97j25emudupq63nyw24cg27h2rspfj9srp'
+
+def test_backends_agree():
+    backends = list(lnecdsa.available_backends().values())
+    assert 'python' in [b.name for b in backends]
+
+    r = random.Random(1)
+    for _ in range(10):
+        secret = r.getrandbits(256).to_bytes(32, 'big')
+        msg = bytes(r.getrandbits(8) for _ in range(r.randrange(300)))
+        results = []
+        for b in backends:
+            sig, recid = b.sign_recoverable(b.privkey(secret), msg)
+            pubkey = b.recover(msg, sig, recid)
+            assert b.verify(b.pubkey(b.serialize(pubkey)), msg, sig)
+            assert not b.verify(pubkey, msg + b'x', sig)
+            assert b.serialize(b.pubkey(pubkey.serialize(compressed=False))) == b.serialize(pubkey)
+
+            # Only low-s signatures verify, but either recovers.
+            s = int.from_bytes(sig[32:], 'big')
+            high = sig[:32] + (lnecdsa.N - s).to_bytes(32, 'big')
+            assert not b.verify(pubkey, msg, high)
+            assert b.serialize(b.recover(msg, high, recid ^ 1)) == b.serialize(pubkey)
+            results.append((sig, recid, b.serialize(pubkey)))
+        assert results == [results[0]] * len(backends)
+
+def test_preferred_backend():
+    # A fixed order, not whichever happens to time fastest.
+    names = list(lnecdsa.available_backends())
+    for _ in range(3):
+        assert lnecdsa.preferred_backend().name == names[0]
+    if 'secp256k1' in names:
+        import secp256k1
+        assert isinstance(lndecode(INVOICE).pubkey, secp256k1.PublicKey)
+
+def test_signature_objects():
+    recovered = lndecode(INVOICE)
+    verified = lndecode(lnencode(LnAddr(RHASH, tags=[('d', ''), ('n', unhexlify(PUBKEY))]), PRIVKEY))
+    if lnecdsa.get_backend().name == 'secp256k1':
+        # Still secp256k1's own signature objects, as before backends.
+        hrp, data, sigdecoded = lnaddr.split_invoice(INVOICE)
+        sigdata = bytes(lnaddr.signing_data(hrp, data))
+        sig, recid = recovered.pubkey.ecdsa_recoverable_serialize(recovered.signature)
+        assert (bytes(sig), recid) == recovered.compact_signature
+        assert recovered.pubkey.ecdsa_verify(
+            sigdata, recovered.pubkey.ecdsa_recoverable_convert(recovered.signature))
+        assert bytes(verified.pubkey.ecdsa_serialize_compact(verified.signature)) == verified.compact_signature[0]
+    else:
+        assert recovered.signature == recovered.compact_signature
+
+    for addr in (recovered, verified):
+        compact = addr.compact_signature
+        addr.signature = addr.signature
+        assert addr.compact_signature == compact
+        addr.signature = None
+        assert addr.compact_signature is None
+
+def test_backend_errors():
+    for b in lnecdsa.available_backends().values():
+        with pytest.raises(ValueError):
+            b.pubkey(b'\x02' + b'\xff' * 32)
+        with pytest.raises(ValueError):
+            b.pubkey(unhexlify(PUBKEY)[:32])
+        with pytest.raises(ValueError):
+            b.recover(b'msg', bytes(64), 0)
+        assert not b.verify(b.pubkey(unhexlify(PUBKEY)), b'msg', bytes(64))
+
+    # An incomplete backend fails when created, not on first use.
+    class Incomplete(lnecdsa.Backend):
+        def privkey(self, secret):
+            return secret
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_python_backend_invoices():
+    saved = lnecdsa.backend
+    try:
+        expected = lndecode(INVOICE)
+        lnecdsa.set_backend('python')
+        addr = lndecode(INVOICE)
+        assert addr_to_dict(addr) == addr_to_dict(expected)
+        assert lnencode(LnAddr(RHASH, amount_msat=250000000, date=1496314658,
+                               tags=[('d', '1 cup coffee'), ('x', 60)]),
+                        PRIVKEY) == INVOICE
+
+        # Verified against `n` rather than recovered.
+        invoice = lnencode(LnAddr(RHASH, tags=[('d', ''), ('n', unhexlify(PUBKEY))]), PRIVKEY)
+        assert lndecode(invoice).pubkey.serialize() == unhexlify(PUBKEY)
+    finally:
+        lnecdsa.backend = saved
+
+def test_pubkey_cache():
+    cache = lnecdsa.PubkeyCache(maxsize=2)
+    keys = [unhexlify(PUBKEY),
+            unhexlify('029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'),
+            unhexlify('039e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255')]
+    first = cache.get(keys[0])
+    assert first.serialize() == keys[0]
+    assert cache.get(bytearray(keys[0])) is first
+    cache.get(keys[1])
+    cache.get(keys[0])
+    cache.get(keys[2])
+    assert len(cache) == 2
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 3, 'evictions': 1}
+    # keys[1] was least recently used.
+    assert cache.get(keys[0]) is first
+    assert cache.stats()['misses'] == 3
+    with pytest.raises(ValueError):
+        cache.get(b'\x02' + b'\xff' * 32)
+
+    # Keys from another backend aren't reused.
+    saved = lnecdsa.backend
+    try:
+        lnecdsa.set_backend('python')
+        assert isinstance(cache.get(keys[0]), lnecdsa.PythonPublicKey)
+    finally:
+        lnecdsa.backend = saved
+
+if __name__ == '__main__':
+    test_backends_agree()
+    test_preferred_backend()
+    test_signature_objects()
+    test_backend_errors()
+    test_python_backend_invoices()
+    test_pubkey_cache()
@@ -0,0 +1,108 @@
+#! /usr/bin/python3
+
+from lnaddr import LnAddr
+from lnexpiry import ExpiryTracker
+
+import asyncio
+import time
+
+
+def make_addr(i, date, expiry=None):
+    tags = [('d', str(i))]
+    if expiry is not None:
+        tags.append(('x', expiry))
+    return LnAddr(bytes([i]) * 32, date=date, tags=tags)
+
+
+def test_pop_expired():
+    tracker = ExpiryTracker()
+    assert tracker.add(make_addr(1, 1000)) == 4600
+    assert tracker.add(make_addr(2, 1000, 60)) == 1060
+    tracker.add(make_addr(3, 1100, 60))
+    tracker.add(make_addr(4, 900, 60))
+    assert len(tracker) == 4
+    assert tracker.next_expiry() == 960
+
+    assert tracker.pop_expired(959) == []
+    assert [a.paymenthash[0] for a in tracker.pop_expired(1060)] == [4, 2]
+    assert len(tracker) == 2
+
+    # Replacing and removing.
+    tracker.add(make_addr(3, 2000, 60))
+    assert tracker.expiry(bytes([3]) * 32) == 2060
+    assert tracker.pop_expired(2000) == []
+    assert tracker.remove(bytes([1]) * 32).tags == [('d', '1')]
+    assert bytes([1]) * 32 not in tracker
+    assert [a.paymenthash[0] for a in tracker.pop_expired(10000)] == [3]
+    assert tracker.next_expiry() is None
+    assert tracker.pop_expired(10000) == []
+
+
+def test_stale_entries_compacted():
+    tracker = ExpiryTracker()
+    for n in range(100):
+        tracker.add(make_addr(0, 1000 + n))
+    assert len(tracker) == 1
+    assert len(tracker.heap) <= 3
+    assert tracker.pop_expired(5000)[0].date == 1099
+
+
+def test_expirations():
+    # Invoices dated 1000 with a 60 second expiry, and a clock 0.1 seconds
+    # short of that.
+    offset = 1059.9 - time.time()
+    tracker = ExpiryTracker(clock=lambda: time.time() + offset)
+
+    async def run():
+        events = tracker.expirations()
+        tracker.add(make_addr(1, 1000, 60))
+        tracker.add(make_addr(2, 900, 60))
+        assert (await events.__anext__()).paymenthash[0] == 2
+
+        # Waits for the next expiry, or is woken by an earlier one.
+        later = asyncio.ensure_future(events.__anext__())
+        await asyncio.sleep(0.01)
+        assert not later.done()
+        tracker.add(make_addr(3, 1059, 0))
+        assert (await asyncio.wait_for(later, 0.05)).paymenthash[0] == 3
+        start = time.time()
+        assert (await asyncio.wait_for(events.__anext__(), 1)).paymenthash[0] == 1
+        assert time.time() - start > 0.05
+
+    asyncio.run(run())
+
+
+def test_expirations_consumers():
+    offset = 1059.9 - time.time()
+    tracker = ExpiryTracker(clock=lambda: time.time() + offset)
+
+    async def run():
+        tracker.add(make_addr(1, 2000, 60))
+        consumers = [tracker.expirations(), tracker.expirations()]
+        waiting = {asyncio.ensure_future(c.__anext__()) for c in consumers}
+        await asyncio.sleep(0.01)
+        assert len(tracker.waiters) == 2
+
+        # Whichever consumer takes the first, the other is still woken
+        # for the second.
+        got = []
+        for i in (2, 3):
+            tracker.add(make_addr(i, 1000, 0))
+            done, waiting = await asyncio.wait(waiting, timeout=0.5,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            assert len(done) == 1
+            got.append(done.pop().result().paymenthash[0])
+        assert got == [2, 3]
+
+        for c in consumers:
+            await c.aclose()
+        assert not tracker.waiters
+
+    asyncio.run(run())
+
+
+if __name__ == '__main__':
+    test_pop_expired()
+    test_stale_entries_compacted()
+    test_expirations()
+    test_expirations_consumers()
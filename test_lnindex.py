@@ -0,0 +1,108 @@
+#! /usr/bin/python3
+
+from binascii import unhexlify
+from lnaddr import LnAddr, lnencode, lndecode
+from lnindex import InvoiceIndex
+
+import random
+
+PRIVKEY=b'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+PUBKEY=b'03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad'
+OTHER_PUBKEY=b'029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'
+
+
+def make_addr(i, date, pubkey=PUBKEY):
+    addr = LnAddr(bytes([i]) * 32, date=date, tags=[('d', str(i))])
+    addr.pubkey = unhexlify(pubkey)
+    return addr
+
+
+def test_index_lookups():
+    invoice = lnencode(LnAddr(bytes([100]) * 32, date=1500, tags=[('d', 'coffee')]), PRIVKEY)
+    index = InvoiceIndex([make_addr(i, 1000 + i * 10) for i in range(10)])
+    index.add(invoice)
+    index.add(make_addr(50, 1005, OTHER_PUBKEY))
+
+    assert len(index) == 12
+    assert index.get(bytes([3]) * 32).date == 1030
+    assert bytes([100]) * 32 in index
+    assert index.get(bytes([99]) * 32) is None
+
+    assert len(index.for_payee(unhexlify(PUBKEY))) == 11
+    assert index.for_payee(lndecode(invoice).pubkey)[-1].tags == [('d', 'coffee')]
+    assert [a.paymenthash[0] for a in index.for_payee(unhexlify(OTHER_PUBKEY))] == [50]
+
+    assert [a.date for a in index.between(1000, 1030)] == [1000, 1005, 1010, 1020]
+    assert [a.date for a in index.between(1085)] == [1090, 1500]
+    assert [a.date for a in index.between()] == sorted(a.date for a in index)
+
+    # Replacing an invoice moves it in the date index.
+    index.add(make_addr(3, 2000))
+    assert len(index) == 12
+    assert [a.date for a in index.between(1030, 1031)] == []
+    assert [a.date for a in index.between(1500)] == [1500, 2000]
+
+
+def test_index_readd():
+    a, b = make_addr(1, 1000), make_addr(2, 5)
+    index = InvoiceIndex([a])
+    # b goes into the overflow, and adding it again mustn't duplicate it.
+    index.add(b)
+    index.add(b)
+    index.add_many([a, b, b])
+    assert [x.date for x in index.between()] == [5, 1000]
+    index.remove(b.paymenthash)
+    assert [x.date for x in index.between()] == [1000]
+    index.add(b)
+    assert [x.date for x in index.between()] == [5, 1000]
+    # Replaced, then back again, within one batch.
+    index.add_many([make_addr(2, 7), b])
+    assert [x.date for x in index.between()] == [5, 1000]
+    assert len(index.for_payee(unhexlify(PUBKEY))) == 2
+
+
+def test_index_no_pubkey():
+    # Not encoded yet, so no payee to index it by.
+    local = LnAddr(bytes([7]) * 32, date=1000, tags=[('d', 'local')])
+    index = InvoiceIndex([make_addr(1, 500)])
+    index.add(local)
+    assert index.get(local.paymenthash) is local
+    assert [a.date for a in index.between()] == [500, 1000]
+    assert len(index.for_payee(unhexlify(PUBKEY))) == 1
+    index.add_many([LnAddr(bytes([8]) * 32, date=900, tags=[])])
+    assert index.remove(local.paymenthash) is local
+    assert [a.paymenthash[0] for a in index.between()] == [1, 8]
+    assert list(index.by_payee) == [unhexlify(PUBKEY)]
+
+
+def test_index_removal():
+    r = random.Random(1)
+    addrs = [make_addr(i, r.randrange(1000, 2000), r.choice([PUBKEY, OTHER_PUBKEY]))
+             for i in range(200)]
+    index = InvoiceIndex()
+    for addr in addrs:
+        index.add(addr)
+
+    removed = index.remove_many([bytes([i]) * 32 for i in range(0, 200, 3)])
+    assert [a.paymenthash[0] for a in removed] == list(range(0, 200, 3))
+    live = [a for a in addrs if a.paymenthash[0] % 3]
+    assert sorted(a.paymenthash for a in index.between()) == sorted(a.paymenthash for a in live)
+    assert index.between(1200, 1400) == sorted([a for a in live if 1200 <= a.date < 1400],
+                                               key=lambda a: a.date)
+    assert (len(index.for_payee(unhexlify(PUBKEY))) + len(index.for_payee(unhexlify(OTHER_PUBKEY)))
+            == len(live))
+
+    # Enough removals compact the date index.
+    index.remove_many([a.paymenthash for a in live[:100]])
+    assert len(index.dates) < 200 - 67
+    assert len(index.between()) == len(live) - 100
+    index.remove_many([a.paymenthash for a in live[100:]])
+    assert len(index) == 0
+    assert index.by_payee == {}
+
+
+if __name__ == '__main__':
+    test_index_lookups()
+    test_index_readd()
+    test_index_no_pubkey()
+    test_index_removal()
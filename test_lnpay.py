@@ -1,10 +1,22 @@
 #! /usr/bin/python3
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 from hashlib import sha256
-from lnaddr import shorten_amount, unshorten_amount, LnAddr, lnencode, lndecode, u5_to_bitarray, bitarray_to_u5
+from lnaddr import shorten_amount, unshorten_amount, shorten_msat, unshorten_msat, LnAddr, UnknownTag, InvoiceSigner, InvoiceTemplate, Counters, set_instrumentation, validate, VALIDATE_CHECKSUM, VALIDATE_STRUCTURE, VALIDATE_SIGNATURE, lnencode, lndecode, lndecode_many, lnencode_many, addr_to_dict, addr_from_dict, get_signer, u5_to_bitarray, bitarray_to_u5
 from decimal import Decimal
 from binascii import unhexlify, hexlify
-from bech32 import bech32_encode, bech32_decode
+from bech32 import bech32_encode, bech32_decode, CHARSET
+
+import bitstring
+import io
+import json
+import lnaddr
+import os
+import pickle
+import pytest
+import subprocess
+import sys
 
 RHASH=unhexlify('0001020304050607080900010203040506070809000102030405060708090102')
 CONVERSION_RATE=1200
@@ -26,6 +38,35 @@ def test_shorten_amount():
         assert shorten_amount(i) == o
         assert unshorten_amount(shorten_amount(i)) == i
 
+def test_shorten_msat():
+    tests = {
+        1: '10p',
+        120: '1200p',
+        100: '1n',
+        12300000: '123u',
+        12300000000: '123m',
+        300000000000: '3',
+    }
+
+    for i, o in tests.items():
+        assert shorten_msat(i) == o
+        assert unshorten_msat(o) == i
+    assert unshorten_msat('0250u') == 25000000
+
+    # Sub-millisatoshi amounts, and anything but digits and a multiplier.
+    for amount in ['1p', '15p', '', 'u', '1x', '1.5m', '-1m', '1 m', '１m']:
+        with pytest.raises(ValueError):
+            unshorten_msat(amount)
+
+    addr = LnAddr(RHASH, amount=Decimal('0.0025'))
+    assert addr.amount_msat == 250000000
+    addr.amount_msat = 1
+    assert addr.amount == Decimal('0.00000000001')
+    assert LnAddr(RHASH, amount=24).amount_msat == 24 * 10**11
+    assert LnAddr(RHASH, amount_msat=5).amount == Decimal(5) / 10**11
+    with pytest.raises(ValueError):
+        LnAddr(RHASH, amount=Decimal('0.000000000001'))
+
 def compare(a, b):
     
     if len([t[1] for t in a.tags if t[0] == 'h']) == 1:
@@ -45,7 +86,8 @@ def compare(a, b):
     b.pubkey = None
     b.signature = None
 
-    assert a.__dict__ == b.__dict__    
+    for k in LnAddr.__slots__:
+        assert getattr(a, k) == getattr(b, k)
 
 def test_roundtrip():
     longdescription = ('One piece of chocolate cake, one icecream cone, one'
@@ -92,7 +134,301 @@ def test_n_decoding():
     lnaddr = lndecode(bech32_encode(hrp, bitarray_to_u5(databits)))
     assert hexlify(lnaddr.pubkey.serialize(compressed=True)) == PUBKEY
 
+def test_route_hops():
+    # 5 hops is exactly 2040 bits: no padding after the last hop.
+    for nhops in (1, 4, 5, 10, 12):
+        route = [(bytes([2]) + bytes([i]) * 32, bytes([i]) * 8, i, 1000 + i, 9 + i)
+                 for i in range(nhops)]
+        addr = lndecode(lnencode(LnAddr(RHASH, tags=[('d', ''), ('r', route)]), PRIVKEY))
+        assert addr.tags[1] == ('r', route)
+        assert addr.unknown_tags == []
+
+def test_encode_vectors():
+    # From examples.sh / README.md.
+    route = [(unhexlify('029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'), unhexlify('0102030405060708'), 1, 20, 3),
+             (unhexlify('039e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'), unhexlify('030405060708090a'), 2, 30, 4)]
+    tests = [
+        (LnAddr(RHASH, amount=0.0025, date=1496314658, tags=[('d', 'ナンセンス 1杯'), ('x', 60)]),
+         'lnbc2500u1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqdpquwpc4curk03c9wlrswe78q4eyqc7d8d0xqzpuyk0sg5g70me25alkluzd2x62aysf2pyy8edtjeevuv4p2d5p76r4zkmneet7uvyakky2zr4cusd45tftc9c5fh0nnqpnl2jfll544esqchsrny'),
+        (LnAddr(RHASH, amount=0.02, date=1496314658, tags=[('h', 'One piece of chocolate cake, one icecream cone, one pickle, one slice of swiss cheese, one slice of salami, one lollypop, one piece of cherry pie, one sausage, one cupcake, and one slice of watermelon'), ('f', '1RustyRX2oai4EYYDpQGWvEL62BBGqN9T'), ('r', route)]),
+         'lnbc20m1pvjluezpp5qqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqqqsyqcyq5rqwzqfqypqhp58yjmdan79s6qqdhdzgynm4zwqd5d7xmw5fk98klysy043l2ahrqsfpp3qjmp7lwpagxun9pygexvgpjdc4jdj85fr9yq20q82gphp2nflc7jtzrcazrra7wwgzxqc8u7754cdlpfrmccae92qgzqvzq2ps8pqqqqqqpqqqqq9qqqvpeuqafqxu92d8lr6fvg0r5gv0heeeqgcrqlnm6jhphu9y00rrhy4grqszsvpcgpy9qqqqqqgqqqqq7qqzqj9n4evl6mr5aj9f58zp6fyjzup6ywn3x6sk8akg5v4tgn2q8g4fhx05wf6juaxu9760yp46454gpg5mtzgerlzezqcqvjnhjh8z3g2qqdhhwkj'),
+    ]
+    for addr, expected in tests:
+        assert lnencode(addr, PRIVKEY) == expected
+
+def test_unknown_tags():
+    # Splice extra fields in before the signature: the signature no longer
+    # matches, but recovery still yields some (other) pubkey.
+    hrp, data = bech32_decode(lnencode(LnAddr(RHASH, amount=24, tags=[('d', '')]), PRIVKEY))
+    unknown = [CHARSET.find('z'), 0, 3, 1, 2, 31]
+    badhash = [CHARSET.find('p'), 0, 2, 7, 7]
+    data = data[:-104] + unknown + badhash + data[-104:]
+    lnaddr = lndecode(bech32_encode(hrp, data))
+    assert lnaddr.unknown_tags == [UnknownTag('z', b'\x08\xbe', 15),
+                                   UnknownTag('p', b'\x39\xc0', 10)]
+    assert [(t.tag, t.bitstream()) for t in lnaddr.unknown_tags] == [('z', bitstring.ConstBitStream('0b000010001011111')),
+                                                                     ('p', bitstring.ConstBitStream('0b0011100111'))]
+    assert lnaddr.paymenthash == RHASH
+    assert lnaddr.tags == [('d', '')]
+
+def test_decode_many():
+    invoices = [lnencode(LnAddr(RHASH, amount=i + 1, tags=[('d', str(i))]), PRIVKEY)
+                for i in range(5)]
+    invoices.insert(2, 'lnbc1notaninvoice')
+
+    for executor in (None, ThreadPoolExecutor(2)):
+        res = list(lndecode_many(invoices, executor, chunksize=2, max_pending=1))
+        assert len(res) == 6
+        assert isinstance(res[2], ValueError)
+        del res[2]
+        assert [a.tags for a in res] == [[('d', str(i))] for i in range(5)]
+
+    # Process pools need to pickle the results.
+    a = lndecode(invoices[0])
+    b = pickle.loads(pickle.dumps(a))
+    assert b.pubkey.serialize() == a.pubkey.serialize()
+    assert b.pubkey.ecdsa_recoverable_serialize(b.signature) == a.pubkey.ecdsa_recoverable_serialize(a.signature)
+
+def test_encode_many():
+    addrs = [LnAddr(RHASH, amount=i + 1, date=1496314658, tags=[('d', str(i))])
+             for i in range(5)]
+    addrs.insert(2, LnAddr(RHASH, tags=[]))
+    expected = [lnencode(a, PRIVKEY) for a in addrs[:2] + addrs[3:]]
+
+    for executor in (None, ThreadPoolExecutor(2)):
+        res = list(lnencode_many(addrs, PRIVKEY, executor, chunksize=2, max_pending=1))
+        assert len(res) == 6
+        assert isinstance(res[2], ValueError)
+        del res[2]
+        assert res == expected
+
+def test_addr_to_dict():
+    route = [(unhexlify('029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'), unhexlify('0102030405060708'), 1, 20, 3)]
+    addr = lndecode(lnencode(LnAddr(RHASH, amount=Decimal('0.001'), date=1496314658,
+                                    tags=[('d', 'coffee'), ('x', 60), ('r', route),
+                                          ('f', '1RustyRX2oai4EYYDpQGWvEL62BBGqN9T')]),
+                             PRIVKEY))
+    d = json.loads(json.dumps(addr_to_dict(addr)))
+    assert d['pubkey'] == PUBKEY.decode()
+    assert d['amount'] == '0.001'
+    assert d['amount_msat'] == 100000000
+    assert d['date'] == 1496314658
+    assert d['description'] == 'coffee'
+    assert d['expiry'] == 60
+    assert d['fallbacks'] == ['1RustyRX2oai4EYYDpQGWvEL62BBGqN9T']
+    assert d['routes'] == [[{'pubkey': '029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255',
+                             'short_channel_id': '0102030405060708',
+                             'feebase': 1, 'feerate': 20, 'cltv': 3}]]
+    assert d['unknown_tags'] == []
+    assert len(d['signature']) == 128
+
+    d['description_hashed'] = d.pop('description')
+    d['fallback'] = d.pop('fallbacks')[0]
+    copy = addr_from_dict(d)
+    assert copy.tags == [('h', 'coffee'), ('x', 60), ('f', '1RustyRX2oai4EYYDpQGWvEL62BBGqN9T'), ('r', route)]
+    assert (copy.paymenthash, copy.amount, copy.date) == (RHASH, Decimal('0.001'), 1496314658)
+    del d['amount_msat']
+    assert addr_from_dict(d).amount_msat == 100000000
+    assert addr_from_dict({'paymenthash': d['paymenthash'], 'amount_msat': '5'}).amount_msat == 5
+
+def test_invoice_signer():
+    signer = InvoiceSigner(PRIVKEY)
+    addrs = [LnAddr(RHASH, amount=i + 1, date=1496314658, tags=[('d', str(i))])
+             for i in range(3)]
+    invoices = signer.encode_many(addrs)
+    assert invoices == [lnencode(a, PRIVKEY) for a in addrs]
+    assert signer.encode(addrs[0]) == invoices[0]
+    assert [lndecode(i).tags for i in invoices] == [a.tags for a in addrs]
+
+    # Only the most recently used keys' signers are kept.
+    assert get_signer(PRIVKEY) is get_signer(PRIVKEY)
+    keys = [hexlify(bytes([i + 1]) * 32) for i in range(lnaddr.MAX_SIGNERS)]
+    for key in keys:
+        get_signer(key)
+    assert len(lnaddr.signers) == lnaddr.MAX_SIGNERS
+    assert PRIVKEY not in lnaddr.signers
+    assert list(lnaddr.signers) == keys
+
+def test_invoice_template():
+    route = [(unhexlify('029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'), unhexlify('0102030405060708'), 1, 20, 3)]
+    for currency, tags in [('bc', [('h', 'One piece of chocolate cake, one icecream cone'),
+                                   ('f', '1RustyRX2oai4EYYDpQGWvEL62BBGqN9T'),
+                                   ('r', route), ('x', 600)]),
+                           ('tb', [('d', 'coffee'), ('f', 'tb1qw508d6qejxtdg4y5r3zarvary0c5xw7kxpjzsx')])]:
+        template = InvoiceTemplate(InvoiceSigner(PRIVKEY), tags, currency)
+        for i, amount_msat in enumerate([None, 100000000, 1]):
+            paymenthash = bytes([i]) * 32
+            expected = lnencode(LnAddr(paymenthash, amount_msat=amount_msat, currency=currency,
+                                       tags=tags, date=1496314658 + i), PRIVKEY)
+            assert template.encode(paymenthash, amount_msat, 1496314658 + i) == expected
+
+    with pytest.raises(ValueError):
+        InvoiceTemplate(InvoiceSigner(PRIVKEY), [('x', 60)])
+
+def test_lazy_decoding():
+    invoice = lnencode(LnAddr(RHASH, amount=24, tags=[('d', 'lazy'), ('x', 60)]), PRIVKEY)
+    eager = lndecode(invoice)
+
+    lazy = lndecode(invoice, lazy=True)
+    assert not lazy.is_decoded('pubkey')
+    assert lazy.paymenthash == RHASH
+    assert lazy.amount == eager.amount
+    assert lazy.tags == eager.tags
+    assert not lazy.is_decoded('pubkey')
+    assert lazy.pubkey.serialize() == eager.pubkey.serialize()
+    lazy.verify()
+
+    projected = lndecode(invoice, fields=['paymenthash', 'amount'])
+    assert projected.is_decoded('paymenthash')
+    assert projected.paymenthash == RHASH
+    assert projected.amount == 24
+    assert projected.amount_msat == 24 * 10**11
+    with pytest.raises(AttributeError):
+        projected.tags
+
+    # Verbose output doesn't depend on how much is decoded.
+    outputs = []
+    for kwargs in ({}, {'lazy': True}, {'fields': ['amount']}):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            lndecode(invoice, verbose=True, **kwargs)
+        outputs.append(out.getvalue())
+    assert 'SHA256 of above' in outputs[0]
+    assert outputs == [outputs[0]] * 3
+
+    # With `n`, the signature is only checked when asked.
+    hrp, data = bech32_decode(lnencode(LnAddr(RHASH, amount=24,
+                                              tags=[('d', ''),
+                                                    ('n', unhexlify(PUBKEY))]),
+                                       PRIVKEY))
+    data[-4] ^= 1
+    lazy = lndecode(bech32_encode(hrp, data), lazy=True)
+    assert hexlify(lazy.pubkey.serialize()) == PUBKEY
+    with pytest.raises(ValueError):
+        lazy.verify()
+
+def test_instrumentation():
+    counters = Counters()
+    old = set_instrumentation(counters)
+    try:
+        invoice = lnencode(LnAddr(RHASH, amount=24, tags=[('f', '1RustyRX2oai4EYYDpQGWvEL62BBGqN9T'), ('d', '')]), PRIVKEY)
+        lndecode(invoice)
+        lndecode(invoice)
+    finally:
+        set_instrumentation(old)
+    lndecode(invoice)
+
+    assert counters.calls == {'lnencode': 1, 'lndecode': 2}
+    assert counters.nbytes['lndecode'] == 2 * len(invoice)
+    assert counters.ntags['lndecode'] == 2 * 3
+    assert set(counters.seconds['lndecode']) == {'bech32', 'unpack', 'tags', 'fallback', 'signature'}
+    assert set(counters.seconds['lnencode']) == {'tags', 'fallback', 'signature', 'bech32'}
+
+def test_validate():
+    invoice = lnencode(LnAddr(RHASH, amount=24, tags=[('d', ''), ('n', unhexlify(PUBKEY))]), PRIVKEY)
+    hrp, data = bech32_decode(invoice)
+    for level in (VALIDATE_CHECKSUM, VALIDATE_STRUCTURE, VALIDATE_SIGNATURE):
+        validate(invoice, level)
+
+    with pytest.raises(ValueError):
+        validate(invoice[:-1] + ('p' if invoice[-1] == 'q' else 'q'), VALIDATE_CHECKSUM)
+
+    # Short `p` field is only caught by structure checks.
+    badp = data[:7] + [CHARSET.find('p'), 1, 19] + data[10:10 + 51] + data[10 + 52:]
+    validate(bech32_encode(hrp, badp), VALIDATE_CHECKSUM)
+    with pytest.raises(ValueError):
+        validate(bech32_encode(hrp, badp), VALIDATE_STRUCTURE)
+    with pytest.raises(ValueError):
+        validate(bech32_encode('lnbc2x', data), VALIDATE_STRUCTURE)
+
+    # Bad signature is only caught by signature checks.
+    data[-4] ^= 1
+    validate(bech32_encode(hrp, data), VALIDATE_STRUCTURE)
+    with pytest.raises(ValueError):
+        validate(bech32_encode(hrp, data), VALIDATE_SIGNATURE)
+
+def test_expected_pubkey():
+    other = '029e03a901b85534ff1e92c43c74431f7ce72046060fcf7a95c37e148f78c77255'
+    invoice = lnencode(LnAddr(RHASH, amount=24, tags=[('d', 'known')]), PRIVKEY)
+    recovered = lndecode(invoice)
+    for pubkey in (PUBKEY.decode(), unhexlify(PUBKEY), recovered.pubkey):
+        addr = lndecode(invoice, expected_pubkey=pubkey)
+        assert addr.pubkey.serialize() == unhexlify(PUBKEY)
+        assert addr.compact_signature == (recovered.compact_signature[0], None)
+        assert addr.tags == recovered.tags
+    with pytest.raises(ValueError):
+        lndecode(invoice, expected_pubkey=other)
+
+    # Lazily, the key is only checked by verify().
+    lazy = lndecode(invoice, lazy=True, expected_pubkey=other)
+    assert lazy.pubkey.serialize() == unhexlify(other)
+    with pytest.raises(ValueError):
+        lazy.verify()
+    lndecode(invoice, lazy=True, expected_pubkey=PUBKEY.decode()).verify()
+
+    # A different `n` is rejected before the signature is even looked at.
+    with_n = lnencode(LnAddr(RHASH, tags=[('d', ''), ('n', unhexlify(PUBKEY))]), PRIVKEY)
+    hrp, data = bech32_decode(with_n)
+    data[-4] ^= 1
+    bad_sig = bech32_encode(hrp, data)
+    with pytest.raises(ValueError, match='Invalid signature'):
+        lndecode(bad_sig, expected_pubkey=unhexlify(PUBKEY))
+    with pytest.raises(ValueError, match='expected public key'):
+        lndecode(bad_sig, expected_pubkey=other)
+    with pytest.raises(ValueError, match='expected public key'):
+        lndecode(with_n, lazy=True, expected_pubkey=other)
+
+    res = list(lndecode_many([invoice, with_n], ThreadPoolExecutor(2), expected_pubkey=other))
+    assert all(isinstance(r, ValueError) for r in res)
+    res = list(lndecode_many([invoice, with_n], expected_pubkey=unhexlify(PUBKEY)))
+    assert [r.pubkey.serialize() for r in res] == [unhexlify(PUBKEY)] * 2
+
+def test_lazy_imports():
+    # A fresh interpreter, as this one has long since loaded everything.
+    code = ("import lnaddr, lnecdsa, sys, types\n"
+            "print([m for m in ('base58', 'bitstring', 'secp256k1', 'coincurve', 'numpy')\n"
+            "       if type(sys.modules.get(m)) is types.ModuleType])\n"
+            "lnaddr.lndecode(sys.argv[1])\n"
+            "print(lnecdsa.backend is not None)\n")
+    invoice = lnencode(LnAddr(RHASH, tags=[('d', 'lazy')]), PRIVKEY)
+    out = subprocess.check_output([sys.executable, '-c', code, invoice],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert out.decode().split('\n') == ['[]', 'True', '']
+
+def test_threaded_first_use():
+    # Modules loaded on first use must be safe to first use from several
+    # threads at once: fallbacks need base58 (and decoding, secp256k1).
+    code = ("from concurrent.futures import ThreadPoolExecutor\n"
+            "import lnaddr, sys\n"
+            "invoices = sys.stdin.read().split()\n"
+            "res = lnaddr.lndecode_many(invoices, ThreadPoolExecutor(16))\n"
+            "print([repr(r) for r in res if isinstance(r, Exception)])\n")
+    invoices = [lnencode(LnAddr(bytes([i]) * 32, tags=[('d', ''), ('f', f)]), PRIVKEY)
+                for i, f in enumerate(['1RustyRX2oai4EYYDpQGWvEL62BBGqN9T',
+                                       '3EktnHQD7RiAE6uzMj2ZifT9YgRrkSgzQX',
+                                       'bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4'] * 50)]
+    for _ in range(3):
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      input='\n'.join(invoices).encode(),
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        assert out.decode() == '[]\n'
+
 if __name__ == '__main__':
     test_shorten_amount()
+    test_shorten_msat()
     test_roundtrip()
     test_n_decoding()
+    test_route_hops()
+    test_encode_vectors()
+    test_unknown_tags()
+    test_decode_many()
+    test_encode_many()
+    test_addr_to_dict()
+    test_invoice_signer()
+    test_invoice_template()
+    test_lazy_decoding()
+    test_instrumentation()
+    test_validate()
+    test_expected_pubkey()
+    test_lazy_imports()
+    test_threaded_first_use()
@@ -0,0 +1,115 @@
+#! /usr/bin/python3
+
+from binascii import hexlify, unhexlify
+from decimal import Decimal
+from lnaddr import LnAddr, lnencode
+from lnserver import InvoiceServer
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+RHASH=unhexlify('0001020304050607080900010203040506070809000102030405060708090102')
+PRIVKEY=b'e126f68f7eafcc8b74f54d269fe206be715000f94dac067d1c04a8ca3b2db734'
+PUBKEY=b'03e7156ae33b0a208d0744199163177e909e80176e55d97a2f221ede0f934dd9ad'
+
+
+async def exchange(reader, writer, reqs):
+    for req in reqs:
+        writer.write((req if isinstance(req, str) else json.dumps(req)).encode() + b'\n')
+    await writer.drain()
+    return [json.loads(await reader.readline()) for _ in reqs]
+
+
+def test_server_tcp():
+    invoices = [lnencode(LnAddr(RHASH, amount=i + 1, date=1496314658, tags=[('d', str(i))]), PRIVKEY)
+                for i in range(20)]
+
+    async def run():
+        server = InvoiceServer(PRIVKEY, batch_size=8)
+        await server.start('127.0.0.1', 0)
+        port = server.server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+        # Pipelined requests come back in order.
+        replies = await exchange(reader, writer, [{'id': i, 'method': 'decode', 'invoice': a}
+                                                  for i, a in enumerate(invoices)])
+        assert [r['id'] for r in replies] == list(range(20))
+        assert [r['result']['description'] for r in replies] == [str(i) for i in range(20)]
+        assert all(r['result']['pubkey'] == PUBKEY.decode() for r in replies)
+
+        replies = await exchange(reader, writer, [
+            {'id': 'enc', 'method': 'encode',
+             'addr': {'paymenthash': hexlify(RHASH).decode(), 'amount': '0.001',
+                      'date': 1496314658, 'description': 'coffee', 'expiry': 60}},
+            {'id': 'bad', 'method': 'decode', 'invoice': invoices[0][:-5] + 'qqqqq'},
+            {'id': 'missing', 'method': 'decode'},
+            {'id': 'what', 'method': 'frobnicate'},
+            'not json',
+            {'id': 'stats', 'method': 'stats'},
+        ])
+        enc, bad, missing, what, notjson, stats = replies
+        assert enc['result']['invoice'] == lnencode(
+            LnAddr(RHASH, amount=Decimal('0.001'), date=1496314658,
+                   tags=[('d', 'coffee'), ('x', 60)]), PRIVKEY)
+        assert 'error' in bad and bad['id'] == 'bad'
+        assert missing['error'] == "Missing field 'invoice'"
+        assert 'error' in what
+        assert notjson['id'] is None and 'error' in notjson
+        assert stats['result']['requests'] == 24
+        assert 0 <= stats['result']['queue_depth'] <= 4
+        assert stats['result']['latency_ms']['p50'] <= stats['result']['latency_ms']['p99']
+
+        writer.close()
+        await writer.wait_closed()
+        await server.close()
+
+    asyncio.run(run())
+
+
+def test_server_unix():
+    invoice = lnencode(LnAddr(RHASH, amount=24, tags=[('d', 'unix')]), PRIVKEY)
+
+    async def run(path):
+        # No private key: encode requests fail, decode still works.
+        server = InvoiceServer(batch_delay=0)
+        await server.start(path=path)
+        reader, writer = await asyncio.open_unix_connection(path)
+        dec, enc = await exchange(reader, writer, [
+            {'method': 'decode', 'invoice': invoice},
+            {'method': 'encode', 'addr': {'paymenthash': hexlify(RHASH).decode()}}])
+        assert dec['result']['description'] == 'unix'
+        assert enc['error'] == 'No private key to encode with'
+        writer.close()
+        await writer.wait_closed()
+        await server.close()
+
+    with tempfile.TemporaryDirectory() as d:
+        asyncio.run(run(os.path.join(d, 'lnserver.sock')))
+
+
+def test_serve_stdio():
+    invoice = lnencode(LnAddr(RHASH, amount=24, tags=[('d', 'stdio')]), PRIVKEY)
+    reqs = [{'id': 1, 'method': 'decode', 'invoice': invoice},
+            {'id': 2, 'method': 'frobnicate'},
+            {'id': 3, 'method': 'stats'}]
+    here = os.path.dirname(os.path.abspath(__file__))
+    out = subprocess.check_output([sys.executable, os.path.join(here, 'lightning-address.py'),
+                                   'serve-stdio'],
+                                  input=''.join(json.dumps(r) + '\n' for r in reqs).encode(),
+                                  cwd=here)
+    dec, what, stats = [json.loads(line) for line in out.decode().splitlines()]
+    assert dec['result']['description'] == 'stdio'
+    assert what['error'] == 'Unknown method frobnicate'
+    assert stats['id'] == 3
+    assert stats['result']['requests'] == 2
+    assert 0 < stats['result']['latency_ms']['p50'] <= stats['result']['latency_ms']['p99']
+
+
+if __name__ == '__main__':
+    test_server_tcp()
+    test_server_unix()
+    test_serve_stdio()